@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark for the prepare and send pipelines.
+Drives JobApplicationSystem against synthetic job DataFrames and the local mock Perplexity
+and Gmail servers, and writes per-stage throughput, latency percentiles and peak memory
+as a machine-readable baseline.
+
+Usage:
+    python benchmark.py --sizes 100,1000,10000 --output bench_results.json
+    python benchmark.py --sizes 1000 --compare bench_results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import pandas as pd
+
+from mock_servers import MockBehavior, start_mock_servers, server_url
+
+STAGES = ['prepare', 'send']
+# Proportion of distinct companies among synthetic jobs; job boards repeat employers often
+COMPANY_RATIO = 0.3
+
+
+def synthetic_jobs(size):
+    """Distinct postings (the title carries the row number, so none are deduplicated) over fewer companies."""
+    companies = max(1, int(size * COMPANY_RATIO))
+    titles = ['React.js Developer', 'Backend Engineer', 'Data Engineer', 'DevOps Engineer', 'QA Engineer']
+    return pd.DataFrame([{
+        'company': f'Company {i % companies}',
+        'title': f'{titles[i % len(titles)]} {i}',
+        'location': 'Bengaluru',
+        'job_url': f'https://www.linkedin.com/jobs/view/{1000000 + i}',
+    } for i in range(size)])
+
+
+def latency_summary(latencies, percentile):
+    return {
+        'p50': round(percentile(latencies, 50), 4),
+        'p95': round(percentile(latencies, 95), 4),
+        'p99': round(percentile(latencies, 99), 4),
+    }
+
+
+def run_stage(fn, trace_memory=False):
+    """Run fn() with stdout silenced. Returns (elapsed_seconds, peak_memory_mb).
+
+    Without trace_memory the peak is the process's resident high-water mark, which only grows
+    across stages; tracemalloc gives a per-stage Python heap peak but slows the stage down."""
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        fn()
+    elapsed = time.perf_counter() - started
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    else:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return elapsed, round(peak / (1024 * 1024), 2)
+
+
+def benchmark_size(main, size, stages, trace_memory=False):
+    """Benchmark each stage for one synthetic job set inside a fresh working directory."""
+    results = []
+    jobs = synthetic_jobs(size)
+    # Only the first site returns jobs so every row is scraped exactly once
+    main.scrape_jobs = lambda site_name, **kwargs: jobs if site_name == main.CONFIG['JOB_SEARCH_SITES'][:1] \
+        else jobs.iloc[:0]
+
+    system = main.JobApplicationSystem()
+    system.pplx.rate_limiter = main.RateLimiter(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        system.authenticate_gmail('benchmark@example.com')
+
+    send_latencies = []
+    send_email = system.send_email
+
+    def timed_send(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return send_email(*args, **kwargs)
+        finally:
+            send_latencies.append(time.perf_counter() - started)
+    system.send_email = timed_send
+
+    for stage in stages:
+        meter = system.pplx.meter
+        calls_before = meter.totals()['calls']
+        if stage == 'prepare':
+            elapsed, peak_mb = run_stage(lambda: system.scrape_and_find_contacts('Developer', 'Bengaluru'),
+                                         trace_memory)
+            # Rows actually looked up: the working directory is fresh, so only dedupe drops any
+            rows_in = len(main.dedupe_jobs(jobs)[0])
+            rows_out = len(pd.read_csv(main.CONFIG['RECIPIENTS_CSV'])) \
+                if os.path.exists(main.CONFIG['RECIPIENTS_CSV']) else 0
+            latencies = meter.latencies.get('contact_lookup', [])
+            llm_latencies = latencies
+        else:
+            if not os.path.exists(main.CONFIG['RECIPIENTS_CSV']):
+                continue
+            elapsed, peak_mb = run_stage(lambda: system.run_sending_process('resume.pdf'), trace_memory)
+            rows_in = len(pd.read_csv(main.CONFIG['RECIPIENTS_CSV']))
+            rows_out = len(send_latencies)
+            latencies = send_latencies
+            llm_latencies = meter.latencies.get('email_generation', [])
+
+        results.append({
+            'size': size,
+            'stage': stage,
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_per_second': round(rows_in / elapsed, 2) if elapsed else None,
+            'latency_seconds': latency_summary(latencies, main.percentile),
+            'llm_latency_seconds': latency_summary(llm_latencies, main.percentile),
+            'llm_calls': meter.totals()['calls'] - calls_before,
+            'peak_memory_mb': peak_mb,
+        })
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = {(r['size'], r['stage']): r for r in json.load(f)['results']}
+    print(f"\nComparison with {baseline_path}:")
+    for result in results:
+        previous = baseline.get((result['size'], result['stage']))
+        if not previous or not previous['throughput_per_second']:
+            continue
+        change = (result['throughput_per_second'] / previous['throughput_per_second'] - 1) * 100
+        print(f"  {result['stage']:>7} @ {result['size']:>6}: throughput {change:+.1f}%, "
+              f"p95 {previous['latency_seconds']['p95']}s -> {result['latency_seconds']['p95']}s, "
+              f"peak memory {previous['peak_memory_mb']}MB -> {result['peak_memory_mb']}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the prepare and send pipelines offline.')
+    parser.add_argument('--sizes', default='100,1000', help='Comma separated job counts, e.g. 100,1000,100000')
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--latency-ms', type=float, default=0, help='Mock LLM latency per call')
+    parser.add_argument('--latency-jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Mock LLM 429/5xx rate')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Per-stage Python heap peak via tracemalloc (slower, skews timings)')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip() in STAGES]
+
+    behavior = MockBehavior(args.latency_ms, args.latency_jitter_ms, args.error_rate, seed=42)
+    llm_server, gmail_server = start_mock_servers(behavior, llm_port=0, gmail_port=0)
+    # main reads these into CONFIG at import time
+    os.environ['PPLX_BASE_URL'] = server_url(llm_server)
+    os.environ['GMAIL_API_ENDPOINT'] = server_url(gmail_server)
+    os.environ.setdefault('PPLX_API_KEY', 'benchmark')
+    import main as mailer
+    mailer.CONFIG['SEND_DELAY_SECONDS'] = 0
+    mailer.CONFIG['LLM_BACKOFF_MAX_SECONDS'] = 1
+
+    output_path = os.path.abspath(args.output)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    results = []
+    start_dir = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix='mailer_bench_') as work_dir:
+            os.chdir(work_dir)
+            try:
+                size_results = benchmark_size(mailer, size, stages, args.trace_memory)
+            finally:
+                os.chdir(start_dir)
+        for result in size_results:
+            print(f"{result['stage']:>7} @ {size:>6} jobs: {result['throughput_per_second']} rows/s, "
+                  f"p50/p95/p99 {result['latency_seconds']['p50']}/{result['latency_seconds']['p95']}/"
+                  f"{result['latency_seconds']['p99']}s, {result['llm_calls']} LLM calls, "
+                  f"peak {result['peak_memory_mb']}MB")
+        results.extend(size_results)
+
+    report = {
+        'generated_at': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'settings': {
+            'latency_ms': args.latency_ms,
+            'latency_jitter_ms': args.latency_jitter_ms,
+            'error_rate': args.error_rate,
+            'trace_memory': args.trace_memory,
+            'contact_lookup_workers': mailer.CONFIG['CONTACT_LOOKUP_WORKERS'],
+            'contact_lookup_batch_size': mailer.CONFIG['CONTACT_LOOKUP_BATCH_SIZE'],
+            'generation_workers': mailer.CONFIG['GENERATION_WORKERS'],
+            'email_batch_size': mailer.CONFIG['EMAIL_BATCH_SIZE'],
+        },
+        'mock_counters': behavior.counters,
+        'results': results,
+    }
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output_path}")
+
+    if compare_path:
+        compare(results, compare_path)
+
+
+if __name__ == "__main__":
+    main()
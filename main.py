@@ -15,12 +15,24 @@ import json
 import time
 import base64
 import re
+import csv
+import math
+import textwrap
+from string import Template
+import random
+import hashlib
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email import encoders
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 import pandas as pd
 from dotenv import load_dotenv
 import pickle
@@ -31,6 +43,7 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+import httplib2
 
 # Job scraping
 try:
@@ -39,12 +52,20 @@ except ImportError:
     print("Warning: python-jobspy not installed. Job scraping will not work.")
     scrape_jobs = None
 
+# HTTP transport
+import requests
+from requests.adapters import HTTPAdapter
+
 # Perplexity API
 try:
     from openai import OpenAI
 except ImportError:
     print("Warning: openai library not installed. Using requests for Perplexity API.")
-    import requests
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 # Configuration
 load_dotenv()
@@ -52,18 +73,117 @@ load_dotenv()
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 CONFIG = {
     'PPLX_API_KEY': os.getenv('PPLX_API_KEY', ''),
+    'PPLX_BASE_URL': os.getenv('PPLX_BASE_URL', 'https://api.perplexity.ai'),
+    'GMAIL_API_ENDPOINT': os.getenv('GMAIL_API_ENDPOINT', ''),  # Set to use a local mock Gmail server
     'PPLX_MODEL': 'llama-3.1-sonar-large-128k-online',
+    # Models tried in order per call site; the next one is used only if a reply can't be parsed
+    'PPLX_MODEL_ROUTES': {
+        'contact_lookup': ['llama-3.1-sonar-small-128k-online', 'llama-3.1-sonar-large-128k-online'],
+        'email_generation': ['llama-3.1-sonar-large-128k-online'],
+        'summarization': ['llama-3.1-sonar-small-128k-online'],
+    },
+    'HTTP_POOL_SIZE': 16,  # Keep-alive connections kept open to the Perplexity API
+    'HTTP_CONNECT_TIMEOUT': 10,
+    'HTTP_READ_TIMEOUT': 60,
+    'LLM_CALL_DEADLINE': 90,  # Upper bound in seconds for any single LLM call, retries included
+    'PPLX_REQUESTS_PER_MINUTE': 50,  # Client-side limits shared by every Perplexity caller
+    'PPLX_TOKENS_PER_MINUTE': 100000,
+    'LLM_MAX_RETRIES': 4,  # Retries for 429/5xx/timeouts; other errors fail immediately
+    'LLM_BACKOFF_BASE_SECONDS': 1,
+    'LLM_BACKOFF_MAX_SECONDS': 60,
+    'LLM_BREAKER_FAILURES': 5,  # Consecutive transient failures that open the circuit breaker
+    'LLM_BREAKER_RESET_SECONDS': 120,  # How long the breaker stays open before a probe call
+    'LLM_HEDGE_ENABLED': False,  # Send a duplicate request when a call runs past the observed p90
+    'LLM_HEDGE_PERCENTILE': 90,
+    'LLM_HEDGE_MAX_RATE': 0.1,  # At most this fraction of attempts may be hedged
+    'LLM_HEDGE_MIN_SAMPLES': 20,  # Latencies to observe before hedging starts
     'RECIPIENTS_CSV': 'recipients.csv',
+    'RECIPIENTS_POLL_SECONDS': 15,  # How often send re-reads recipients.csv while prepare is running
+    'RECIPIENTS_STALE_MINUTES': 30,  # Ignore a prepare-in-progress marker not refreshed for this long
     'BLOCKED_DOMAINS_FILE': 'blocked_domains.json',
     'CREDENTIALS_FILE': 'credentials.json',
     'MAX_JOBS_TO_SCRAPE': 100,
+    'JOB_MAX_HOURS_OLD': 72,
+    'SEEN_JOBS_FILE': 'seen_jobs.json',
+    'SEEN_JOBS_RETENTION_DAYS': 30,
     'JOB_SEARCH_SITES': ['linkedin', 'indeed'],
+    'SCRAPE_WORKERS': 4,  # Parallel scrape tasks (one per site/title/location)
     'JOB_SEARCH_COUNTRY': 'India',
     'JOB_SEARCH_LOCATION': 'Bengaluru',
-    'RESUME_SUMMARY_FILE': 'resume_summary.txt'
+    'CONTACT_LOOKUP_WORKERS': 8,  # Max concurrent contact lookups (1 = sequential)
+    'CONTACT_LOOKUP_BATCH_SIZE': 5,  # Jobs packed into one lookup prompt (1 = one query per job)
+    'RESUME_SUMMARY_FILE': 'resume_summary.txt',
+    'SEND_DELAY_SECONDS': 2,  # Pause between sends to avoid rapid-fire triggers
+    'GENERATION_WORKERS': 4,  # Email drafts generated concurrently ahead of the sender
+    'DRAFT_QUEUE_SIZE': 8,  # Max drafts generating or ready ahead of the sender (1 = no lookahead)
+    'EMAIL_BATCH_SIZE': 4,  # Recipients written for in one generation prompt (1 = one query per email)
+    'LLM_CACHE_ENABLED': True,
+    'LLM_CACHE_FILE': 'llm_cache.sqlite3',
+    'LLM_CACHE_TTL_HOURS': 24 * 7,
+    'LLM_CACHE_MAX_ENTRIES': 5000,
+    'LLM_USAGE_REPORT_DIR': 'usage_reports',
+    'PROMPT_FIELD_MAX_CHARS': 300,  # Cap for any single value substituted into a prompt
+    'PROMPT_RESUME_MAX_CHARS': 2000,
+    'PROMPT_MAX_TOKENS': 4000,  # Estimated prompt size above which a call is refused; batches then fall back
+    # Per-run limits enforced across prepare and send (None = unlimited)
+    'BUDGET_MAX_LLM_TOKENS': None,
+    'BUDGET_MAX_LLM_CALLS': None,
+    'BUDGET_MAX_WALL_SECONDS': None,
+    'BUDGET_MAX_SENDS': None,
+    'COMPANY_CONTACTS_FILE': 'company_contacts.json',
+    'DRAFTS_FILE': 'email_drafts.json',
+    'DRAFTS_RETENTION_DAYS': 30,  # Unsent drafts older than this are dropped
+    'NEGATIVE_CACHE_TTL_HOURS': 72  # How long "no email found" results are trusted
 }
 
 
+# Query parameters that identify a posting; everything else (tracking, referrers) is dropped
+JOB_URL_ID_PARAMS = {'jk', 'vjk', 'currentjobid', 'jobid', 'id'}
+
+
+def _normalize_text(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return ''
+    return re.sub(r'[^a-z0-9]+', ' ', str(value).lower()).strip()
+
+
+def canonical_job_url(url):
+    """Normalize a job URL so the same posting compares equal across sites and tracking links."""
+    if not isinstance(url, str) or not url.strip():
+        return ''
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = urlencode(sorted(
+        (k.lower(), v) for k, v in parse_qsl(parts.query) if k.lower() in JOB_URL_ID_PARAMS
+    ))
+    return urlunsplit(('https', host, parts.path.rstrip('/'), query, ''))
+
+
+def job_fingerprint(job):
+    """Stable identity of a posting based on company, title and location.
+    
+    Empty when any of them is missing, since such postings can't be told apart by these fields."""
+    fields = [_normalize_text(job.get(field)) for field in ('company', 'title', 'location')]
+    if not all(fields):
+        return ''
+    return hashlib.sha1('|'.join(fields).encode('utf-8')).hexdigest()
+
+
+def dedupe_jobs(jobs):
+    """Drop postings that share a fingerprint or canonical URL. Returns (jobs, removed_count)."""
+    if jobs.empty:
+        return jobs, 0
+    jobs = jobs.copy()
+    jobs['job_fingerprint'] = [job_fingerprint(job) for _, job in jobs.iterrows()]
+    canonical_urls = jobs['job_url'].map(canonical_job_url) if 'job_url' in jobs else pd.Series('', index=jobs.index)
+    duplicate = jobs['job_fingerprint'].duplicated() & (jobs['job_fingerprint'] != '')
+    duplicate |= canonical_urls.duplicated() & (canonical_urls != '')
+    deduped = jobs[~duplicate].reset_index(drop=True)
+    return deduped, len(jobs) - len(deduped)
+
+
 class BlockedDomainsManager:
     """Manage blocked email domains and addresses."""
     
@@ -114,10 +234,13 @@ class SendingStateManager:
     def load(self):
         if Path(self.file_path).exists():
             with open(self.file_path, 'r') as f:
-                return json.load(f)
+                state = json.load(f)
+            state.setdefault('retry_rows', [])
+            return state
         return {
             'last_index_sent': -1,
             'sent_emails': [],
+            'retry_rows': [],  # Rows whose send failed; offered again before new rows next run
             'last_run_date': None
         }
     
@@ -127,65 +250,1404 @@ class SendingStateManager:
             json.dump(self.state, f, indent=2)
     
     def mark_sent(self, index, email):
-        self.state['last_index_sent'] = index
+        self.state['last_index_sent'] = max(index, self.state['last_index_sent'])
+        if index in self.state['retry_rows']:
+            self.state['retry_rows'].remove(index)
         if email.lower() not in [e.lower() for e in self.state['sent_emails']]:
             self.state['sent_emails'].append(email.lower())
         self.save()
     
+    def mark_failed(self, index):
+        if index not in self.state['retry_rows']:
+            self.state['retry_rows'].append(index)
+            self.save()
+    
     def was_sent(self, email):
         return email.lower() in [e.lower() for e in self.state['sent_emails']]
 
 
+class RecipientsWriter:
+    """Append contacts to the recipients CSV one row at a time, flushed to disk per row."""
+    
+    FIELDS = ['company_name', 'recipient_name', 'designation', 'email', 'job_title', 'job_url']
+    
+    def __init__(self, file_path=CONFIG['RECIPIENTS_CSV']):
+        self.file_path = file_path
+        self.marker_path = f'{file_path}.inprogress'
+        self.lock = threading.Lock()
+        self.written = 0
+        self.fields = self.FIELDS
+        self.seen = set()
+        self.file = None
+        self.writer = None
+    
+    def __enter__(self):
+        self.open()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def open(self):
+        is_new = not Path(self.file_path).exists() or os.path.getsize(self.file_path) == 0
+        if not is_new:
+            # Keep the existing header and skip rows already written by an earlier run
+            with open(self.file_path, 'r', newline='') as f:
+                reader = csv.DictReader(f)
+                self.fields = reader.fieldnames or self.FIELDS
+                for row in reader:
+                    self.seen.add(self._row_key(row))
+        self.file = open(self.file_path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fields, extrasaction='ignore')
+        if is_new:
+            self.writer.writeheader()
+            self.file.flush()
+        self._touch_marker()
+    
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if Path(self.marker_path).exists():
+            os.remove(self.marker_path)
+    
+    @staticmethod
+    def _row_key(row):
+        return (str(row.get('email', '')).strip().lower(), str(row.get('job_url', '') or '').strip())
+    
+    def _touch_marker(self):
+        with open(self.marker_path, 'w') as f:
+            f.write(datetime.now().isoformat())
+    
+    def write(self, contact):
+        key = self._row_key(contact)
+        with self.lock:
+            if key in self.seen:
+                return False
+            self.seen.add(key)
+            self.writer.writerow(contact)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.written += 1
+            self._touch_marker()
+            return True
+    
+    @staticmethod
+    def is_in_progress(file_path=CONFIG['RECIPIENTS_CSV']):
+        """Whether a prepare run is still appending to the given recipients file."""
+        marker_path = Path(f'{file_path}.inprogress')
+        if not marker_path.exists():
+            return False
+        age = time.time() - marker_path.stat().st_mtime
+        return age < CONFIG['RECIPIENTS_STALE_MINUTES'] * 60
+
+
+class CompanyContactStore:
+    """Persist found contacts per company and cache companies with no known email.
+    
+    Writes are batched; call flush() once done adding contacts."""
+    
+    SAVE_EVERY = 50
+    
+    def __init__(self, file_path=CONFIG['COMPANY_CONTACTS_FILE'],
+                 negative_ttl_hours=CONFIG['NEGATIVE_CACHE_TTL_HOURS']):
+        self.file_path = file_path
+        self.negative_ttl = timedelta(hours=negative_ttl_hours)
+        self.lock = threading.Lock()
+        self.company_locks = {}
+        self.unsaved = 0
+        self.data = self.load()
+    
+    def load(self):
+        if Path(self.file_path).exists():
+            with open(self.file_path, 'r') as f:
+                return json.load(f)
+        return {'contacts': {}, 'not_found': {}}
+    
+    def save(self):
+        with open(self.file_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        self.unsaved = 0
+    
+    def _changed(self):
+        self.unsaved += 1
+        if self.unsaved >= self.SAVE_EVERY:
+            self.save()
+    
+    def flush(self):
+        with self.lock:
+            if self.unsaved:
+                self.save()
+    
+    @staticmethod
+    def normalize(company):
+        """Store key for a company name; empty when the name is missing (None or NaN)."""
+        return _normalize_text(company)
+    
+    def company_lock(self, company):
+        """Lock serializing lookups for one company so concurrent jobs share a single query."""
+        key = self.normalize(company)
+        with self.lock:
+            if key not in self.company_locks:
+                self.company_locks[key] = threading.Lock()
+            return self.company_locks[key]
+    
+    def get_contact(self, company):
+        with self.lock:
+            return self.data['contacts'].get(self.normalize(company))
+    
+    def is_known_miss(self, company):
+        with self.lock:
+            checked_at = self.data['not_found'].get(self.normalize(company))
+        if not checked_at:
+            return False
+        return datetime.now() - datetime.fromisoformat(checked_at) < self.negative_ttl
+    
+    def add_contact(self, company, contact):
+        key = self.normalize(company)
+        with self.lock:
+            self.data['contacts'][key] = contact
+            self.data['not_found'].pop(key, None)
+            self._changed()
+    
+    def add_miss(self, company):
+        with self.lock:
+            self.data['not_found'][self.normalize(company)] = datetime.now().isoformat()
+            self._changed()
+
+
+class DraftStore:
+    """Persist generated email drafts per recipient and resume summary, so sends can skip the LLM.
+    
+    Writes are batched; call flush() once done adding drafts."""
+    
+    SAVE_EVERY = 25
+    
+    def __init__(self, file_path=CONFIG['DRAFTS_FILE']):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        self.data = self.load()
+    
+    def load(self):
+        if Path(self.file_path).exists():
+            with open(self.file_path, 'r') as f:
+                return json.load(f)
+        return {'drafts': {}}
+    
+    def save(self):
+        cutoff = (datetime.now() - timedelta(days=CONFIG['DRAFTS_RETENTION_DAYS'])).isoformat()
+        self.data['drafts'] = {k: v for k, v in self.data['drafts'].items() if v['created_at'] >= cutoff}
+        with open(self.file_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        self.unsaved = 0
+    
+    @staticmethod
+    def key(email, resume_summary):
+        resume_hash = hashlib.sha256(resume_summary.encode('utf-8')).hexdigest()[:16]
+        return f"{str(email).strip().lower()}|{resume_hash}"
+    
+    def get(self, email, resume_summary):
+        with self.lock:
+            return self.data['drafts'].get(self.key(email, resume_summary))
+    
+    def add(self, recipient, resume_summary, content):
+        with self.lock:
+            self.data['drafts'][self.key(recipient['email'], resume_summary)] = {
+                'email': recipient['email'],
+                'company_name': recipient['company_name'],
+                'job_title': recipient['job_title'],
+                'subject': content['subject'],
+                'body': content['body'],
+                'created_at': datetime.now().isoformat(),
+            }
+            self.unsaved += 1
+            if self.unsaved >= self.SAVE_EVERY:
+                self.save()
+    
+    def remove(self, email, resume_summary):
+        with self.lock:
+            if self.data['drafts'].pop(self.key(email, resume_summary), None):
+                self.unsaved += 1
+                if self.unsaved >= self.SAVE_EVERY:
+                    self.save()
+    
+    def flush(self):
+        with self.lock:
+            if self.unsaved:
+                self.save()
+    
+    def __len__(self):
+        with self.lock:
+            return len(self.data['drafts'])
+
+
+class LLMResponseCache:
+    """Persistent SQLite cache of LLM responses with TTL and LRU eviction."""
+    
+    def __init__(self, file_path=CONFIG['LLM_CACHE_FILE'],
+                 ttl_hours=CONFIG['LLM_CACHE_TTL_HOURS'],
+                 max_entries=CONFIG['LLM_CACHE_MAX_ENTRIES']):
+        self.file_path = file_path
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_accessed REAL NOT NULL)"
+        )
+        self.conn.commit()
+    
+    @staticmethod
+    def make_key(model, system_prompt, prompt):
+        raw = json.dumps([model, system_prompt, prompt])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                self.conn.execute("UPDATE responses SET last_accessed = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+            self.misses += 1
+            return None
+    
+    def set(self, key, response):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_accessed) "
+                "VALUES (?, ?, ?, ?)", (key, response, now, now)
+            )
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            # Evict least recently used entries beyond the size limit
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self.conn.commit()
+    
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class SeenJobsIndex:
+    """Remember processed postings and per-search high-water marks across runs."""
+    
+    OVERLAP_HOURS = 1  # Re-scrape a little before the last run to cover posting delays
+    
+    def __init__(self, file_path=CONFIG['SEEN_JOBS_FILE']):
+        self.file_path = file_path
+        self.data = self.load()
+    
+    def load(self):
+        if Path(self.file_path).exists():
+            with open(self.file_path, 'r') as f:
+                return json.load(f)
+        return {'seen': {}, 'high_water': {}}
+    
+    def save(self):
+        cutoff = (datetime.now() - timedelta(days=CONFIG['SEEN_JOBS_RETENTION_DAYS'])).isoformat()
+        self.data['seen'] = {k: v for k, v in self.data['seen'].items() if v >= cutoff}
+        with open(self.file_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+    
+    @staticmethod
+    def query_key(job_title, location):
+        return f'{_normalize_text(job_title)}|{_normalize_text(location)}'
+    
+    @staticmethod
+    def _job_keys(job):
+        fingerprint = job.get('job_fingerprint')
+        if not isinstance(fingerprint, str) or not fingerprint:
+            fingerprint = job_fingerprint(job)
+        url = canonical_job_url(job.get('job_url'))
+        return [key for key in (fingerprint, url) if key]
+    
+    def hours_old_for(self, job_title, location):
+        """Hours of postings to scrape: the time since the last completed run, capped at the max."""
+        max_hours = CONFIG['JOB_MAX_HOURS_OLD']
+        last_run = self.data['high_water'].get(self.query_key(job_title, location))
+        if not last_run:
+            return max_hours
+        elapsed = (datetime.now() - datetime.fromisoformat(last_run)).total_seconds() / 3600
+        return max(1, min(max_hours, int(elapsed) + 1 + self.OVERLAP_HOURS))
+    
+    def filter_new(self, jobs):
+        """Drop postings processed in earlier runs. Returns (jobs, skipped_count)."""
+        if jobs.empty:
+            return jobs, 0
+        is_new = [not any(k in self.data['seen'] for k in self._job_keys(job))
+                  for _, job in jobs.iterrows()]
+        new_jobs = jobs[is_new].reset_index(drop=True)
+        return new_jobs, len(jobs) - len(new_jobs)
+    
+    def mark_run_complete(self, queries, jobs, scraped_at, failed_rows=()):
+        """Record jobs whose lookup was answered and, once none failed, advance the high-water
+        mark of each fully scraped query. Failed rows stay unseen so a later run retries them."""
+        now = datetime.now().isoformat()
+        answered = jobs.drop(index=jobs.index[list(failed_rows)])
+        for _, job in answered.iterrows():
+            for key in self._job_keys(job):
+                self.data['seen'][key] = now
+        if not failed_rows:
+            for job_title, location in queries:
+                self.data['high_water'][self.query_key(job_title, location)] = scraped_at
+        self.save()
+
+
+class PrepareStateManager:
+    """Track scrape and contact lookup progress per search so prepare can resume."""
+    
+    SLUG_LENGTH = 40
+    
+    def __init__(self, job_titles, locations):
+        # A readable prefix plus a hash of the query set keeps names short however many queries there are
+        queries = sorted({f'{title.strip().lower()}|{location.strip().lower()}'
+                          for title in job_titles for location in locations})
+        digest = hashlib.sha1('\n'.join(queries).encode('utf-8')).hexdigest()[:12]
+        slug = re.sub(r'[^a-z0-9]+', '_', queries[0]).strip('_')[:self.SLUG_LENGTH]
+        self.file_path = f'prepare_state_{slug}_{digest}.json'
+        self.jobs_file = f'prepare_jobs_{slug}_{digest}.csv'
+        self.state = self.load()
+    
+    def load(self):
+        if Path(self.file_path).exists():
+            with open(self.file_path, 'r') as f:
+                return json.load(f)
+        return self.initial_state()
+    
+    @staticmethod
+    def initial_state():
+        return {
+            'scraped_at': None,
+            'queries': [],
+            'processed_through': 0,  # Rows below this index have been looked up...
+            'retry_rows': [],  # ...except these, whose lookups failed and are retried if the run resumes
+            'completed': False,
+            'last_run_date': None
+        }
+    
+    def save(self):
+        self.state['last_run_date'] = datetime.now().isoformat()
+        with open(self.file_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+    
+    def can_resume(self):
+        return (self.state['scraped_at'] is not None and not self.state['completed']
+                and Path(self.jobs_file).exists())
+    
+    def load_jobs(self):
+        return pd.read_csv(self.jobs_file)
+    
+    def start(self, jobs, queries):
+        """Checkpoint a freshly scraped job set, discarding any earlier progress."""
+        jobs.to_csv(self.jobs_file, index=False)
+        self.state = self.initial_state()
+        self.state['scraped_at'] = datetime.now().isoformat()
+        self.state['queries'] = [list(query) for query in queries]
+        self.save()
+    
+    def mark_processed(self, row_ids, failed_ids=()):
+        """Checkpoint rows handled in order. Failed rows stay pending so a resumed run retries them."""
+        retry = set(self.state['retry_rows']).difference(row_ids).union(failed_ids)
+        self.state['retry_rows'] = sorted(retry)
+        self.state['processed_through'] = max([self.state['processed_through']] + [i + 1 for i in row_ids])
+        self.save()
+    
+    def pending_rows(self, total):
+        """Row indexes still to look up out of `total` jobs, in order."""
+        return sorted(set(self.state['retry_rows']) | set(range(self.state['processed_through'], total)))
+    
+    def mark_completed(self):
+        self.state['completed'] = True
+        self.save()
+
+
+class HTTPPolicy:
+    """Connection pooling and timeout settings shared by both Perplexity transports."""
+    
+    def __init__(self, pool_size=CONFIG['HTTP_POOL_SIZE'],
+                 connect_timeout=CONFIG['HTTP_CONNECT_TIMEOUT'],
+                 read_timeout=CONFIG['HTTP_READ_TIMEOUT'],
+                 deadline=CONFIG['LLM_CALL_DEADLINE']):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+    
+    def read_timeout_for(self, expires=None):
+        """Socket read timeout, shortened to what is left before the monotonic time `expires`."""
+        if expires is None:
+            return self.read_timeout
+        return max(0.1, min(self.read_timeout, expires - time.monotonic()))
+    
+    def requests_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    
+    def requests_timeout(self, expires=None):
+        return (self.connect_timeout, self.read_timeout_for(expires))
+    
+    def openai_client_kwargs(self):
+        """Pool and timeout options for the OpenAI client (its default pool if httpx is missing)."""
+        if httpx is None:
+            return {'timeout': self.read_timeout}
+        return {'http_client': httpx.Client(
+            limits=httpx.Limits(max_connections=self.pool_size,
+                                max_keepalive_connections=self.pool_size),
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+        )}
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) used for limits and budgets."""
+    return len(text) // 4 + 1 if text else 0
+
+
+class JSONStreamScanner:
+    """Incrementally find the first JSON object (or array of objects) in streamed text.
+    
+    Bracketed text that does not parse, such as "[1]" citations, is skipped."""
+    
+    CLOSERS = {'{': '}', '[': ']'}
+    
+    def __init__(self, json_start='{'):
+        self.opener = json_start
+        self.text = ''
+        self.value = None
+        self.end = None
+        self.pos = 0
+        self._reset(None)
+    
+    def _reset(self, start):
+        self.start = start
+        self.depth = 1 if start is not None else 0
+        self.in_string = False
+        self.escaped = False
+    
+    def _accept(self, segment):
+        try:
+            value = json.loads(segment)
+        except ValueError:
+            return False
+        if self.opener == '{':
+            ok = isinstance(value, dict)
+        else:
+            ok = isinstance(value, list) and all(isinstance(item, dict) for item in value)
+        if ok:
+            self.value = value
+        return ok
+    
+    def feed(self, chunk):
+        """Add streamed text. Returns True once the first complete JSON value has been seen."""
+        self.text += chunk
+        while self.end is None and self.pos < len(self.text):
+            char = self.text[self.pos]
+            self.pos += 1
+            if self.start is None:
+                if char == self.opener:
+                    self._reset(self.pos - 1)
+            elif self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    if self._accept(self.text[self.start:self.pos]):
+                        self.end = self.pos
+                    else:
+                        # Not the value we want; rescan from just after its opening bracket
+                        self.pos = self.start + 1
+                        self._reset(None)
+        return self.end is not None
+    
+    def result(self):
+        """The text up to the end of the JSON value, or everything received if it never completed."""
+        return self.text[:self.end] if self.end is not None else self.text
+
+
+def extract_json(text, json_start='{'):
+    """Parse the first JSON object (or, for '[', array of objects) in an LLM reply, or return None."""
+    while text:
+        scanner = JSONStreamScanner(json_start)
+        if scanner.feed(text):
+            return scanner.value
+        if scanner.start is None:
+            return None
+        # An unbalanced bracket swallowed the rest of the text; retry after it
+        text = text[scanner.start + 1:]
+    return None
+
+
+# A bare "null" answer, optionally inside a ```json fence
+NULL_REPLY = re.compile(r'\s*(```(json)?\s*)?null\s*(```)?\s*', re.IGNORECASE)
+
+
+class LLMDeadlineExceeded(Exception):
+    """Raised while receiving a reply once the call's deadline (LLM_CALL_DEADLINE) has passed."""
+
+
+def llm_error_status(error):
+    """HTTP status code carried by an OpenAI or requests exception, if any."""
+    response = getattr(error, 'response', None)
+    return getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+
+
+def classify_llm_error(error):
+    """Return (retryable, retry_after_seconds) for an exception raised by either transport."""
+    response = getattr(error, 'response', None)
+    status = llm_error_status(error)
+    if status is None:
+        transient = isinstance(error, (requests.Timeout, requests.ConnectionError)) or \
+            any(word in type(error).__name__ for word in ('Timeout', 'Connection'))
+        return transient, None
+    if status != 429 and status < 500:
+        return False, None
+    
+    retry_after = None
+    header = (getattr(response, 'headers', None) or {}).get('retry-after')
+    if header:
+        try:
+            retry_after = max(0.0, float(header))
+        except ValueError:
+            try:
+                retry_date = parsedate_to_datetime(header)
+                retry_after = max(0.0, (retry_date - datetime.now(retry_date.tzinfo)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return True, retry_after
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute that back off when the API throttles us.
+    
+    The allowed rate is halved on every 429 and recovers gradually on success (AIMD)."""
+    
+    MIN_FACTOR = 0.1
+    RECOVERY_STEP = 0.05
+    BURST_SECONDS = 10  # Bucket capacity, as seconds' worth of the current rate
+    
+    def __init__(self, requests_per_minute=CONFIG['PPLX_REQUESTS_PER_MINUTE'],
+                 tokens_per_minute=CONFIG['PPLX_TOKENS_PER_MINUTE']):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.factor = 1.0
+        self.request_allowance = self._capacity(requests_per_minute)
+        self.token_allowance = self._capacity(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self.waited_seconds = 0.0
+        self.throttles = 0
+        self.lock = threading.Lock()
+    
+    def _capacity(self, per_minute):
+        return max(1.0, per_minute * self.factor * self.BURST_SECONDS / 60)
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.request_allowance = min(self._capacity(self.requests_per_minute),
+                                     self.request_allowance + elapsed * self.requests_per_minute * self.factor / 60)
+        self.token_allowance = min(self._capacity(self.tokens_per_minute),
+                                   self.token_allowance + elapsed * self.tokens_per_minute * self.factor / 60)
+    
+    def acquire(self, tokens=1):
+        """Block until one request carrying roughly `tokens` tokens may be sent."""
+        while True:
+            with self.lock:
+                self._refill()
+                # Requests larger than the bucket only wait for a full bucket
+                tokens_needed = min(tokens, self._capacity(self.tokens_per_minute))
+                if self.request_allowance >= 1 and self.token_allowance >= tokens_needed:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens_needed
+                    return
+                wait = max(
+                    (1 - self.request_allowance) * 60 / (self.requests_per_minute * self.factor),
+                    (tokens_needed - self.token_allowance) * 60 / (self.tokens_per_minute * self.factor)
+                )
+                self.waited_seconds += wait
+            time.sleep(wait)
+    
+    def on_throttled(self):
+        with self.lock:
+            self.throttles += 1
+            self.factor = max(self.MIN_FACTOR, self.factor / 2)
+            self.request_allowance = min(self.request_allowance, 0)
+    
+    def on_success(self):
+        with self.lock:
+            self.factor = min(1.0, self.factor + self.RECOVERY_STEP)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'requests_per_minute': round(self.requests_per_minute * self.factor, 1),
+                'throttles': self.throttles,
+                'waited_seconds': round(self.waited_seconds, 1)
+            }
+
+
+class CircuitBreaker:
+    """Stop calling an API after repeated transient failures, probing again after a cool-down."""
+    
+    def __init__(self, failure_threshold=CONFIG['LLM_BREAKER_FAILURES'],
+                 reset_seconds=CONFIG['LLM_BREAKER_RESET_SECONDS']):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.probe_thread = None
+        self.trips = 0
+        self.lock = threading.Lock()
+    
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.reset_seconds:
+                return False
+            # Half-open: let a single probe call through
+            self.probing = True
+            self.probe_thread = threading.get_ident()
+            return True
+    
+    def release_probe(self):
+        """End this thread's probe without a verdict, so the next call may probe instead."""
+        with self.lock:
+            if self.probing and self.probe_thread == threading.get_ident():
+                self.probing = False
+    
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing:
+                # The probe failed: stay open for another cool-down
+                self.opened_at = time.time()
+                self.probing = False
+            elif self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self.trips += 1
+    
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class LLMUnavailable(Exception):
+    """Raised when the LLM circuit breaker is open; the pipeline stops and keeps its checkpoint."""
+
+
+class BudgetExhausted(Exception):
+    """Raised when a per-run budget is used up; the pipeline stops and keeps its checkpoint."""
+
+
+class RunBudget:
+    """Hard per-run limits on LLM tokens, LLM calls, wall-clock time and emails sent."""
+    
+    def __init__(self, max_llm_tokens=CONFIG['BUDGET_MAX_LLM_TOKENS'],
+                 max_llm_calls=CONFIG['BUDGET_MAX_LLM_CALLS'],
+                 max_wall_seconds=CONFIG['BUDGET_MAX_WALL_SECONDS'],
+                 max_sends=CONFIG['BUDGET_MAX_SENDS']):
+        self.max_llm_tokens = max_llm_tokens
+        self.max_llm_calls = max_llm_calls
+        self.max_wall_seconds = max_wall_seconds
+        self.max_sends = max_sends
+        self.started = time.monotonic()
+        self.llm_tokens = 0
+        self.llm_calls = 0
+        self.sends = 0
+        self.lock = threading.Lock()
+    
+    def start_clock(self):
+        """Start the wall-clock budget now, so prompts and sign-in before a stage don't count against it."""
+        self.started = time.monotonic()
+    
+    def reserve_llm_call(self):
+        """Count an LLM call before it is made, so concurrent callers can't overshoot the limit."""
+        self.check()
+        with self.lock:
+            if self.max_llm_calls is not None and self.llm_calls >= self.max_llm_calls:
+                raise BudgetExhausted(f"LLM call budget of {self.max_llm_calls} used up")
+            self.llm_calls += 1
+    
+    def charge_llm(self, tokens):
+        with self.lock:
+            self.llm_tokens += tokens
+    
+    def charge_send(self):
+        with self.lock:
+            self.sends += 1
+    
+    def sends_left(self):
+        """Emails that may still be sent, or None without a send limit."""
+        with self.lock:
+            if self.max_sends is None:
+                return None
+            return max(0, self.max_sends - self.sends)
+    
+    def exhausted(self, include_sends=False, include_llm=True):
+        """Name of the first exhausted budget, or None. Send limits only apply when asked for."""
+        with self.lock:
+            if include_llm and self.max_llm_tokens is not None and self.llm_tokens >= self.max_llm_tokens:
+                return f"LLM token budget of {self.max_llm_tokens} used up"
+            if include_llm and self.max_llm_calls is not None and self.llm_calls >= self.max_llm_calls:
+                return f"LLM call budget of {self.max_llm_calls} used up"
+            if self.max_wall_seconds is not None and time.monotonic() - self.started >= self.max_wall_seconds:
+                return f"wall-clock budget of {self.max_wall_seconds}s used up"
+            if include_sends and self.max_sends is not None and self.sends >= self.max_sends:
+                return f"send budget of {self.max_sends} emails used up"
+        return None
+    
+    def check(self, include_sends=False):
+        reason = self.exhausted(include_sends)
+        if reason:
+            raise BudgetExhausted(reason)
+
+
+class UsageMeter:
+    """Account tokens, latency and model per LLM call, broken down by call site."""
+    
+    def __init__(self, report_dir=CONFIG['LLM_USAGE_REPORT_DIR']):
+        self.report_dir = report_dir
+        self.started_at = datetime.now()
+        self.run_id = self.started_at.strftime('%Y%m%d_%H%M%S')
+        self.sites = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+    
+    def _site(self, call_site):
+        return self.sites.setdefault(call_site, {
+            'calls': 0, 'cached_calls': 0, 'failed_calls': 0, 'estimated_calls': 0,
+            'prompt_tokens': 0, 'completion_tokens': 0, 'latency_seconds': 0.0, 'models': {},
+            'prompts_sized': 0, 'estimated_prompt_tokens': 0, 'max_estimated_prompt_tokens': 0,
+            'oversized_prompts': 0
+        })
+    
+    def record_prompt_size(self, call_site, estimated_tokens, oversized=False):
+        """Account the pre-send size estimate of a prompt, to compare with billed prompt tokens."""
+        with self.lock:
+            site = self._site(call_site)
+            site['prompts_sized'] += 1
+            site['estimated_prompt_tokens'] += estimated_tokens
+            site['max_estimated_prompt_tokens'] = max(site['max_estimated_prompt_tokens'], estimated_tokens)
+            site['oversized_prompts'] += int(oversized)
+    
+    def record(self, call_site, model, prompt_tokens, completion_tokens, latency,
+               cached=False, estimated=False, failed=False):
+        with self.lock:
+            site = self._site(call_site)
+            site['calls'] += 1
+            site['cached_calls'] += int(cached)
+            site['failed_calls'] += int(failed)
+            site['estimated_calls'] += int(estimated)
+            site['prompt_tokens'] += prompt_tokens
+            site['completion_tokens'] += completion_tokens
+            site['latency_seconds'] += latency
+            site['models'][model] = site['models'].get(model, 0) + 1
+            self.latencies.setdefault(call_site, []).append(latency)
+    
+    def totals(self):
+        with self.lock:
+            sites = list(self.sites.values())
+        return {
+            'calls': sum(site['calls'] for site in sites),
+            'cached_calls': sum(site['cached_calls'] for site in sites),
+            'failed_calls': sum(site['failed_calls'] for site in sites),
+            'prompt_tokens': sum(site['prompt_tokens'] for site in sites),
+            'completion_tokens': sum(site['completion_tokens'] for site in sites),
+            'latency_seconds': round(sum(site['latency_seconds'] for site in sites), 3),
+        }
+    
+    def summary(self):
+        with self.lock:
+            call_sites = {}
+            for name, site in self.sites.items():
+                latencies = self.latencies.get(name) or [0]
+                call_sites[name] = dict(
+                    site,
+                    models=dict(site['models']),
+                    latency_seconds=round(site['latency_seconds'], 3),
+                    p50_latency_seconds=round(percentile(latencies, 50), 3),
+                    p95_latency_seconds=round(percentile(latencies, 95), 3),
+                    max_latency_seconds=round(max(latencies), 3)
+                )
+        return {
+            'run_id': self.run_id,
+            'started_at': self.started_at.isoformat(),
+            'totals': self.totals(),
+            'call_sites': call_sites
+        }
+    
+    def write_report(self):
+        """Write the usage summary for this run and return the report path."""
+        Path(self.report_dir).mkdir(parents=True, exist_ok=True)
+        report_path = Path(self.report_dir) / f'llm_usage_{self.run_id}.json'
+        with open(report_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        return report_path
+
+
+class RequestHedger:
+    """Fire a backup request when the primary runs past the observed latency percentile."""
+    
+    WINDOW = 200  # Recent latencies kept per model and mode
+    
+    def __init__(self, workers=CONFIG['HTTP_POOL_SIZE'] * 2, percentile_rank=CONFIG['LLM_HEDGE_PERCENTILE'],
+                 max_rate=CONFIG['LLM_HEDGE_MAX_RATE'], min_samples=CONFIG['LLM_HEDGE_MIN_SAMPLES']):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.percentile_rank = percentile_rank
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.latencies = {}
+        self.attempts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.lock = threading.Lock()
+    
+    def _hedge_delay(self, key):
+        """Seconds to wait before hedging, or None if this attempt must not be hedged."""
+        with self.lock:
+            self.attempts += 1
+            samples = self.latencies.get(key)
+            if not samples or len(samples) < self.min_samples:
+                return None
+            if self.hedges + 1 > self.max_rate * self.attempts:
+                return None
+            return percentile(list(samples), self.percentile_rank)
+    
+    def _observe(self, key, latency):
+        with self.lock:
+            self.latencies.setdefault(key, deque(maxlen=self.WINDOW)).append(latency)
+    
+    def run(self, key, fn, before_hedge=None, on_discarded=None):
+        """Run fn(), hedging it with a second fn() if it is slow.
+        
+        before_hedge runs before the backup and may return False to skip it. on_discarded is
+        called with the future of whichever copy's outcome was not returned, once it finishes."""
+        started = time.monotonic()
+        delay = self._hedge_delay(key)
+        if delay is None:
+            result = fn()
+            self._observe(key, time.monotonic() - started)
+            return result
+        
+        primary = self.executor.submit(fn)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            result = primary.result()
+            self._observe(key, time.monotonic() - started)
+            return result
+        
+        if before_hedge and not before_hedge():
+            result = primary.result()
+            self._observe(key, time.monotonic() - started)
+            return result
+        with self.lock:
+            self.hedges += 1
+        backup = self.executor.submit(fn)
+        pending = {primary, backup}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # Take a success if any copy has one; a failure only counts once both copies have failed
+            succeeded = [future for future in (primary, backup) if future in done and future.exception() is None]
+            if not succeeded and pending:
+                continue
+            future = succeeded[0] if succeeded else primary
+            if future is backup:
+                with self.lock:
+                    self.hedge_wins += 1
+            self._observe(key, time.monotonic() - started)
+            if on_discarded:
+                other = backup if future is primary else primary
+                other.add_done_callback(on_discarded)
+            return future.result()
+    
+    def stats(self):
+        with self.lock:
+            return {'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one execution shared by all callers."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+    
+    def do(self, key, fn):
+        """Run fn() unless an identical call is in flight. Returns (result, shared)."""
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result'], True
+        
+        try:
+            call['result'] = fn()
+            return call['result'], False
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call['done'].set()
+
+
 class PerplexityClient:
     """Interact with Perplexity AI API."""
     
-    def __init__(self, api_key=CONFIG['PPLX_API_KEY']):
+    def __init__(self, api_key=CONFIG['PPLX_API_KEY'], use_cache=CONFIG['LLM_CACHE_ENABLED'], budget=None,
+                 base_url=CONFIG['PPLX_BASE_URL']):
         self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.cache = LLMResponseCache() if use_cache else None
+        self.budget = budget or RunBudget()
+        self.http_policy = HTTPPolicy()
+        self.session = self.http_policy.requests_session()
+        self.breaker = CircuitBreaker()
+        self.rate_limiter = RateLimiter()
+        self.meter = UsageMeter()
+        self.single_flight = SingleFlight()
+        self.hedger = RequestHedger() if CONFIG['LLM_HEDGE_ENABLED'] else None
+        self.stats_lock = threading.Lock()
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0, 'breaker_rejections': 0, 'coalesced': 0}
         try:
-            self.client = OpenAI(api_key=api_key, base_url="https://api.perplexity.ai")
+            # Retries are handled by _query_api so both transports share one policy
+            self.client = OpenAI(api_key=api_key, base_url=self.base_url, max_retries=0,
+                                 **self.http_policy.openai_client_kwargs())
             self.use_openai_lib = True
         except:            self.use_openai_lib = False
 
-    def query(self, prompt, system_prompt="You are a helpful assistant."):
-        if self.use_openai_lib:
-            try:
-                response = self.client.chat.completions.create(
-                    model=CONFIG['PPLX_MODEL'],
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-                return response.choices[0].message.content
-            except Exception as e:
-                print(f"Error querying Perplexity: {e}")
+    def query(self, prompt, system_prompt="You are a helpful assistant.", use_cache=True, deadline=None,
+              stream=False, json_start='{', model=None, task=None):
+        """Send a chat completion. deadline caps the wait in seconds (default LLM_CALL_DEADLINE).
+        
+        With stream=True the reply is streamed and the stream is closed as soon as the first
+        complete JSON value starting with json_start ('{' or '[') has arrived. task names the
+        call site for usage accounting."""
+        model = model or CONFIG['PPLX_MODEL']
+        json_start = json_start if stream else None
+        call_site = task or 'default'
+        started = time.monotonic()
+        key = LLMResponseCache.make_key(model, system_prompt, prompt)
+        use_cache = use_cache and self.cache is not None
+        if use_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.meter.record(call_site, model, 0, 0, time.monotonic() - started, cached=True)
+                return cached
+        
+        def call_api():
+            # Checked before anything is spent; callers of batch prompts fall back to single-item ones
+            prompt_estimate = estimate_tokens(system_prompt) + estimate_tokens(prompt)
+            oversized = prompt_estimate > CONFIG['PROMPT_MAX_TOKENS']
+            self.meter.record_prompt_size(call_site, prompt_estimate, oversized)
+            if oversized:
+                print(f"Prompt for {call_site} is ~{prompt_estimate} tokens, over PROMPT_MAX_TOKENS "
+                      f"({CONFIG['PROMPT_MAX_TOKENS']}); not sending it.")
                 return None
+            # Raises BudgetExhausted before any tokens are spent on a call we can't afford
+            self.budget.reserve_llm_call()
+            result, usage = self._query_api(prompt, system_prompt, model, deadline, json_start, call_site)
+            self._record_usage(call_site, model, prompt, system_prompt, result, usage, started)
+            if result and use_cache:
+                self.cache.set(key, result)
+            return result
+        
+        # Identical prompts already in flight share that request instead of sending another
+        result, shared = self.single_flight.do((key, json_start), call_api)
+        if shared:
+            self._count('coalesced')
+            self.meter.record(call_site, model, 0, 0, time.monotonic() - started, cached=True)
+        return result
+
+    def _record_usage(self, call_site, model, prompt, system_prompt, result, usage, started):
+        latency = time.monotonic() - started
+        if result is None:
+            self.meter.record(call_site, model, 0, 0, latency, failed=True)
+        elif usage:
+            prompt_tokens = usage.get('prompt_tokens') or 0
+            completion_tokens = usage.get('completion_tokens') or 0
+            self.meter.record(call_site, model, prompt_tokens, completion_tokens, latency)
+            self.budget.charge_llm(prompt_tokens + completion_tokens)
+        else:
+            # Early-terminated streams never receive the provider's usage block
+            prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(prompt)
+            completion_tokens = estimate_tokens(result)
+            self.meter.record(call_site, model, prompt_tokens, completion_tokens, latency, estimated=True)
+            self.budget.charge_llm(prompt_tokens + completion_tokens)
+
+    @staticmethod
+    def models_for(task):
+        return CONFIG['PPLX_MODEL_ROUTES'].get(task) or [CONFIG['PPLX_MODEL']]
+
+    def query_json(self, prompt, system_prompt, task, json_start='{'):
+        """Query the models routed to `task` until one reply contains parseable JSON.
+        
+        Returns (value, answered): answered is False only if no model replied at all. An explicit
+        "null" reply counts as an answer and is not escalated to the next model."""
+        answered = False
+        for model in self.models_for(task):
+            result_str = self.query(prompt, system_prompt, stream=True, json_start=json_start,
+                                    model=model, task=task)
+            if not result_str:
+                continue
+            answered = True
+            value = extract_json(result_str, json_start)
+            if value is not None or NULL_REPLY.fullmatch(result_str):
+                return value, True
+            print(f"Could not parse reply from {model} for {task}; escalating...")
+        return None, answered
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache else {'hits': 0, 'misses': 0}
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def retry_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['breaker_trips'] = self.breaker.trips
+        stats['breaker_open'] = self.breaker.is_open()
+        stats['rate_limiter'] = self.rate_limiter.stats()
+        stats.update(self.hedger.stats() if self.hedger else {'hedges': 0, 'hedge_wins': 0})
+        return stats
+
+    def _query_api(self, prompt, system_prompt, model, deadline=None, json_start=None, call_site='default'):
+        """Call the API with retries. Returns (content, usage), or (None, None) on failure.
+        
+        deadline bounds the whole call in seconds, retries and backoff included. Raises
+        LLMUnavailable while the circuit breaker is open, so callers stop instead of skipping work."""
+        expires = time.monotonic() + (deadline or self.http_policy.deadline)
+        # Prompt size plus an allowance for the reply
+        tokens = estimate_tokens(system_prompt) + estimate_tokens(prompt) + 500
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._count('breaker_rejections')
+                raise LLMUnavailable(f"Perplexity API unavailable: circuit breaker open after "
+                                     f"{self.breaker.failure_threshold} consecutive failures")
+            try:
+                self.rate_limiter.acquire(tokens)
+                if time.monotonic() >= expires:
+                    self._count('failures')
+                    print("Perplexity call deadline passed before the request could be sent.")
+                    return None, None
+                self._count('calls')
+                if json_start:
+                    send = lambda: self._stream_request(prompt, system_prompt, model, expires, json_start)
+                else:
+                    send = lambda: self._send_request(prompt, system_prompt, model, expires)
+                try:
+                    if self.hedger:
+                        hedge_started = time.monotonic()
+                        
+                        def before_hedge():
+                            # The backup is a real call: it takes a budget slot and a rate limiter turn
+                            try:
+                                self.budget.reserve_llm_call()
+                            except BudgetExhausted:
+                                return False
+                            self.rate_limiter.acquire(tokens)
+                            self._count('calls')
+                            return True
+                        
+                        def on_discarded(future):
+                            # The copy that lost (or failed alongside the other) was paid for too
+                            result, usage = (None, None) if future.exception() else future.result()
+                            self._record_usage(call_site, model, prompt, system_prompt, result, usage,
+                                               hedge_started)
+                        
+                        result = self.hedger.run((model, bool(json_start)), send,
+                                                 before_hedge=before_hedge, on_discarded=on_discarded)
+                    else:
+                        result = send()
+                    self.breaker.record_success()
+                    self.rate_limiter.on_success()
+                    return result
+                except Exception as e:
+                    retryable, retry_after = classify_llm_error(e)
+                    if llm_error_status(e) == 429:
+                        self.rate_limiter.on_throttled()
+                    if retryable:
+                        self.breaker.record_failure()
+                    # Exponential backoff with full jitter, unless the server told us how long to wait
+                    backoff = min(CONFIG['LLM_BACKOFF_MAX_SECONDS'],
+                                  CONFIG['LLM_BACKOFF_BASE_SECONDS'] * 2 ** attempt)
+                    delay = retry_after if retry_after is not None else random.uniform(0, backoff)
+                    delay = min(delay, CONFIG['LLM_BACKOFF_MAX_SECONDS'])
+                    out_of_time = time.monotonic() + delay >= expires
+                    if not retryable or attempt >= CONFIG['LLM_MAX_RETRIES'] or out_of_time:
+                        self._count('failures')
+                        note = " (no time left to retry before the call deadline)" \
+                            if retryable and out_of_time else ""
+                        print(f"Error querying Perplexity: {e}{note}")
+                        return None, None
+                    self._count('retries')
+                    print(f"Transient Perplexity error ({e}); retrying in {delay:.1f}s...")
+                    time.sleep(delay)
+                    attempt += 1
+            finally:
+                # Outcomes that are neither success nor a transient failure must not leave a probe hanging
+                self.breaker.release_probe()
+
+    def _send_request(self, prompt, system_prompt, model, expires=None):
+        if self.use_openai_lib:
+            response = self.client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt}
+                ],
+                timeout=self.http_policy.read_timeout_for(expires)
+            )
+            usage = response.usage
+            if usage:
+                usage = {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens}
+            return response.choices[0].message.content, usage
         else:
             # Fallback to requests
-            url = "https://api.perplexity.ai/chat/completions"
+            url = f"{self.base_url}/chat/completions"
             headers = {
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json"
             }
             payload = {
-                "model": CONFIG['PPLX_MODEL'],
+                "model": model,
                 "messages": [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt}
                 ]
             }
+            response = self.session.post(url, headers=headers, json=payload,
+                                         timeout=self.http_policy.requests_timeout(expires))
+            response.raise_for_status()
+            data = response.json()
+            return data['choices'][0]['message']['content'], data.get('usage')
+
+    @staticmethod
+    def _check_deadline(expires):
+        # Socket timeouts only bound each read, so a reply that keeps trickling in is cut off here
+        if expires is not None and time.monotonic() >= expires:
+            raise LLMDeadlineExceeded("LLM call deadline exceeded while streaming the reply")
+
+    def _stream_request(self, prompt, system_prompt, model, expires, json_start):
+        scanner = JSONStreamScanner(json_start)
+        usage = None
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ]
+        if self.use_openai_lib:
+            stream = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                timeout=self.http_policy.read_timeout_for(expires)
+            )
+            try:
+                for chunk in stream:
+                    self._check_deadline(expires)
+                    if getattr(chunk, 'usage', None):
+                        usage = {'prompt_tokens': chunk.usage.prompt_tokens,
+                                 'completion_tokens': chunk.usage.completion_tokens}
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta and scanner.feed(delta):
+                        break
+            finally:
+                stream.close()
+        else:
+            url = f"{self.base_url}/chat/completions"
+            headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            }
+            payload = {"model": model, "messages": messages, "stream": True}
+            response = self.session.post(url, headers=headers, json=payload, stream=True,
+                                         timeout=self.http_policy.requests_timeout(expires))
             try:
-                response = requests.post(url, headers=headers, json=payload)
                 response.raise_for_status()
-                return response.json()['choices'][0]['message']['content']
-            except Exception as e:
-                print(f"Error querying Perplexity via requests: {e}")
-                return None
+                for line in response.iter_lines(decode_unicode=True):
+                    self._check_deadline(expires)
+                    # Server-sent events: "data: {...}" lines, terminated by "data: [DONE]"
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    chunk = json.loads(data)
+                    usage = chunk.get('usage') or usage
+                    choices = chunk.get('choices') or [{}]
+                    delta = (choices[0].get('delta') or {}).get('content')
+                    if delta and scanner.feed(delta):
+                        break
+            finally:
+                response.close()
+        return scanner.result(), usage
+
+
+class PromptTemplate:
+    """A prompt with whitespace compacted once at definition time and length-capped fields.
+    
+    Fields use $name placeholders so JSON examples need no brace escaping. The static text
+    should come first so the prompt prefix stays identical between calls."""
+    
+    def __init__(self, text, max_lengths=None, default_max_length=CONFIG['PROMPT_FIELD_MAX_CHARS']):
+        lines = (re.sub(r'[ \t]+', ' ', line).strip() for line in textwrap.dedent(text).splitlines())
+        self.template = Template('\n'.join(line for line in lines if line))
+        self.max_lengths = max_lengths or {}
+        self.default_max_length = default_max_length
+        self.static_tokens = estimate_tokens(self.template.safe_substitute({
+            name: '' for name in self.field_names()
+        }))
+    
+    def field_names(self):
+        return {match.group('named') or match.group('braced')
+                for match in self.template.pattern.finditer(self.template.template)
+                if match.group('named') or match.group('braced')}
+    
+    @staticmethod
+    def clip(value, limit):
+        """Normalize a field value to single-spaced text of at most `limit` characters."""
+        if value is None or (isinstance(value, float) and pd.isna(value)):
+            return ''
+        value = re.sub(r'\s+', ' ', str(value)).strip()
+        if limit is not None and len(value) > limit:
+            value = value[:max(0, limit - 3)].rstrip() + '...'
+        return value
+    
+    def render(self, **fields):
+        """Substitute fields. Fields capped at None are pre-rendered blocks and pass through as-is."""
+        values = {}
+        for name, value in fields.items():
+            limit = self.max_lengths.get(name, self.default_max_length)
+            values[name] = value if limit is None else self.clip(value, limit)
+        return self.template.substitute(values)
+    
+    def max_tokens(self):
+        """Upper bound on the rendered prompt size, if every field is capped."""
+        caps = [self.max_lengths.get(name, self.default_max_length) for name in self.field_names()]
+        if None in caps:
+            return None
+        return self.static_tokens + sum(estimate_tokens('x' * cap) for cap in caps)
+
+
+CONTACT_LOOKUP_PROMPT = PromptTemplate("""
+    Find the HR Manager or Engineering Manager email of the hiring company for the job listing below.
+    Prefer a specific person's name and email.
+    Return ONLY a JSON object: {"company_name": "...", "recipient_name": "Name or 'HR Manager'", "designation": "Specific Role", "email": "email@example.com"}
+    If you cannot find an email, return null.
+    Company: $company
+    Job title: $title
+    Job listing: $url
+""")
+
+BATCH_CONTACT_LOOKUP_PROMPT = PromptTemplate("""
+    For each job listing below, find the HR Manager or Engineering Manager email of the hiring company.
+    Prefer a specific person's name and email.
+    Return ONLY a JSON array with one object per listing: [{"index": 0, "company_name": "...", "recipient_name": "Name or 'HR Manager'", "designation": "Specific Role", "email": "email@example.com or null if you cannot find one"}]
+    Listings:
+    $listing
+""", max_lengths={'listing': None})
+
+EMAIL_GENERATION_PROMPT = PromptTemplate("""
+    Generate a highly personalized job application email.
+    Requirements:
+    - Subject line must be professional and catchy.
+    - Body must mention specific requirements from the job if available.
+    - Tone: Enthusiastic but professional.
+    - Mention that a resume is attached.
+    Output as JSON: {"subject": "...", "body": "..."}
+    Context:
+    - Recipient Name: $recipient_name
+    - Designation: $designation
+    - Company: $company_name
+    - Job Title: $job_title
+    - Job Details: $job_url
+    - My Resume Summary: $resume_summary
+""", max_lengths={'resume_summary': CONFIG['PROMPT_RESUME_MAX_CHARS']})
+
+BATCH_EMAIL_GENERATION_PROMPT = PromptTemplate("""
+    Generate a highly personalized job application email for each recipient below.
+    Requirements:
+    - Subject line must be professional and catchy.
+    - Body must mention specific requirements from the job if available.
+    - Tone: Enthusiastic but professional.
+    - Mention that a resume is attached.
+    - Write each email for its own recipient, company and job only.
+    Return ONLY a JSON array with one object per recipient: [{"index": 0, "subject": "...", "body": "..."}]
+    My Resume Summary: $resume_summary
+    Recipients:
+    $recipients
+""", max_lengths={'resume_summary': CONFIG['PROMPT_RESUME_MAX_CHARS'], 'recipients': None})
+
+
+# Single-item prompts are what oversized batches fall back to, so they must always be sendable
+for _name, _template in (('CONTACT_LOOKUP_PROMPT', CONTACT_LOOKUP_PROMPT),
+                         ('EMAIL_GENERATION_PROMPT', EMAIL_GENERATION_PROMPT)):
+    if _template.max_tokens() > CONFIG['PROMPT_MAX_TOKENS']:
+        raise ValueError(f"{_name} can reach ~{_template.max_tokens()} tokens, over PROMPT_MAX_TOKENS "
+                         f"({CONFIG['PROMPT_MAX_TOKENS']}); raise the limit or lower the field caps.")
 
 
 class JobApplicationSystem:
+    TEST_MODE_PREVIEWS = 3  # Drafts shown before a test-mode send run stops
+    
     def __init__(self):
-        self.pplx = PerplexityClient()
+        self.budget = RunBudget()
+        self.pplx = PerplexityClient(budget=self.budget)
+        self.contact_store = CompanyContactStore()
+        self.draft_store = DraftStore()
         self.gmail_service = None
         self.sender_email = None
         self.resume_path = None
@@ -193,6 +1655,8 @@ class JobApplicationSystem:
 
     def authenticate_gmail(self, sender_email):
         self.sender_email = sender_email
+        if CONFIG['GMAIL_API_ENDPOINT']:
+            return self._connect_mock_gmail()
         creds_path = f"token_{sender_email.replace('@', '_at_').replace('.', '_')}.json"
         creds = None
         
@@ -219,64 +1683,246 @@ class JobApplicationSystem:
             print(f"Error building Gmail service: {e}")
             return False
 
-    def scrape_and_find_contacts(self, job_title, location):
+    def _connect_mock_gmail(self):
+        """Point the Gmail client at GMAIL_API_ENDPOINT without OAuth (see mock_servers.py)."""
+        try:
+            self.gmail_service = build(
+                'gmail', 'v1', http=httplib2.Http(), static_discovery=True,
+                client_options={'api_endpoint': CONFIG['GMAIL_API_ENDPOINT']}
+            )
+            print(f"Using mock Gmail API at {CONFIG['GMAIL_API_ENDPOINT']}")
+            return True
+        except Exception as e:
+            print(f"Error building mock Gmail service: {e}")
+            return False
+
+    def scrape_and_find_contacts(self, job_titles, locations):
         if not scrape_jobs:
             print("Job scraping tool not available.")
             return
+        
+        job_titles = [job_titles] if isinstance(job_titles, str) else list(job_titles)
+        locations = [locations] if isinstance(locations, str) else list(locations)
+        search_label = f"{', '.join(job_titles)}' in '{', '.join(locations)}"
+        self.budget.start_clock()
+        
+        prepare_state = PrepareStateManager(job_titles, locations)
+        seen_index = SeenJobsIndex()
+        if prepare_state.can_resume():
+            jobs = prepare_state.load_jobs()
+            print(f"Resuming previous run for '{search_label}' "
+                  f"({len(jobs) - len(prepare_state.pending_rows(len(jobs)))}/{len(jobs)} jobs already processed)...")
+        else:
+            queries = [(title, location) for title in job_titles for location in locations]
+            jobs, scraped_queries = self._scrape_queries(queries, seen_index)
+            jobs, removed = dedupe_jobs(jobs)
+            if removed:
+                print(f"Removed {removed} duplicate job postings.")
+            jobs, skipped = seen_index.filter_new(jobs)
+            if skipped:
+                print(f"Skipping {skipped} jobs already processed in earlier runs.")
+            prepare_state.start(jobs, scraped_queries)
+        
+        print(f"Found {len(jobs)} jobs. Finding HR contacts...")
+        pending_ids = set(prepare_state.pending_rows(len(jobs)))
+        pending = [(i, job) for i, (_, job) in enumerate(jobs.iterrows()) if i in pending_ids]
+        workers = max(1, int(CONFIG['CONTACT_LOOKUP_WORKERS']))
+        batch_size = max(1, int(CONFIG['CONTACT_LOOKUP_BATCH_SIZE']))
+        chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        batch_ids = [[row_id for row_id, _ in chunk] for chunk in chunks]
+        batches = [[job for _, job in chunk] for chunk in chunks]
+        if batch_size > 1:
+            lookup = self._find_contacts_batch
+        else:
+            lookup = lambda batch: [self._find_contact(batch[0])]
+
+        writer = RecipientsWriter()
+        
+        def checkpoint(row_ids, results):
+            self._write_contacts(writer, [contact for contact, _ in results])
+            # Rows whose lookup failed on API errors stay pending for the next run
+            prepare_state.mark_processed(row_ids, [row_id for row_id, (_, answered) in zip(row_ids, results)
+                                                   if not answered])
+        
+        try:
+            with writer:
+                if workers == 1:
+                    for row_ids, batch in zip(batch_ids, batches):
+                        self.budget.check()
+                        checkpoint(row_ids, lookup(batch))
+                else:
+                    # executor.map yields in job order while bounding in-flight lookups
+                    executor = ThreadPoolExecutor(max_workers=workers)
+                    try:
+                        for row_ids, batch_results in zip(batch_ids, executor.map(lookup, batches)):
+                            checkpoint(row_ids, batch_results)
+                            self.budget.check()
+                    finally:
+                        executor.shutdown(cancel_futures=True)
+            failed_rows = prepare_state.state['retry_rows']
+            seen_index.mark_run_complete(prepare_state.state['queries'], jobs, prepare_state.state['scraped_at'],
+                                         failed_rows)
+            # Failed jobs stay unseen, so the next fresh scrape picks them up again instead of
+            # this checkpoint staying open (and blocking new scrapes) until they succeed
+            prepare_state.mark_completed()
+            if failed_rows:
+                print(f"{len(failed_rows)} lookups failed on API errors; the next run will retry them.")
+        except (BudgetExhausted, LLMUnavailable) as e:
+            print(f"Stopping prepare: {e}. Progress is checkpointed; run again to resume.")
+        finally:
+            self.contact_store.flush()
+        
+        if writer.written:
+            print(f"Saved {writer.written} new contacts to {CONFIG['RECIPIENTS_CSV']}")
+        else:
+            print("No new contacts found.")
+        self.print_llm_stats()
+
+    def _scrape_queries(self, queries, seen_index):
+        """Scrape every site/title/location combination in parallel.
+        
+        Returns the merged jobs and the queries whose sites all scraped successfully."""
+        tasks = []
+        for job_title, location in queries:
+            hours_old = seen_index.hours_old_for(job_title, location)
+            for site in CONFIG['JOB_SEARCH_SITES']:
+                tasks.append((site, job_title, location, hours_old))
+        
+        def scrape_task(task):
+            site, job_title, location, hours_old = task
+            print(f"Scraping {site} for '{job_title}' in '{location}' posted in the last {hours_old}h...")
+            try:
+                return scrape_jobs(
+                    site_name=[site],
+                    search_term=job_title,
+                    location=location,
+                    results_wanted=CONFIG['MAX_JOBS_TO_SCRAPE'],
+                    hours_old=hours_old,
+                    country_indeed=CONFIG['JOB_SEARCH_COUNTRY']
+                )
+            except Exception as e:
+                print(f"Error scraping {site} for '{job_title}' in '{location}': {e}")
+                return None
+        
+        workers = max(1, int(CONFIG['SCRAPE_WORKERS']))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(scrape_task, tasks))
+        
+        failed = {(job_title, location) for (_, job_title, location, _), frame in zip(tasks, results)
+                  if frame is None}
+        frames = [frame for frame in results if frame is not None and not frame.empty]
+        jobs = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        return jobs, [query for query in queries if query not in failed]
+
+    def _write_contacts(self, writer, contacts):
+        for contact in contacts:
+            if contact:
+                writer.write(contact)
+
+    def print_llm_stats(self):
+        stats = self.pplx.cache_stats()
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{self.pplx.retry_stats()['coalesced']} in-flight duplicates coalesced")
+        stats = self.pplx.retry_stats()
+        print(f"LLM calls: {stats['calls']} attempts, {stats['retries']} retries, "
+              f"{stats['failures']} failures, circuit breaker tripped {stats['breaker_trips']} times")
+        if stats['hedges']:
+            print(f"LLM hedging: {stats['hedges']} backup requests, {stats['hedge_wins']} finished first")
+        limiter = stats['rate_limiter']
+        print(f"LLM rate limit: {limiter['requests_per_minute']} req/min now, {limiter['throttles']} throttles, "
+              f"{limiter['waited_seconds']}s spent waiting")
+        totals = self.pplx.meter.totals()
+        print(f"LLM usage: {totals['calls']} calls, {totals['prompt_tokens']} prompt + "
+              f"{totals['completion_tokens']} completion tokens, {totals['latency_seconds']}s total latency")
+        print(f"Usage report written to {self.pplx.meter.write_report()}")
+
+    def _find_contact(self, job):
+        """Contact for a job from the store or the LLM. Returns (contact or None, whether it was answered)."""
+        company = job.get('company', 'Unknown Company')
+        title = job.get('title', 'Unknown Title')
+        url = job.get('job_url', '')
+        
+        if not self.contact_store.normalize(company):
+            # Postings without a company name can't share a stored contact with anything
+            return self._lookup_contact('Unknown Company', title, url)
+        
+        with self.contact_store.company_lock(company):
+            known = self.contact_store.get_contact(company)
+            if known:
+                print(f"Reusing: {known['email']} for {company}")
+                return dict(known, job_title=title, job_url=url), True
+            if self.contact_store.is_known_miss(company):
+                return None, True
             
-        print(f"Scraping jobs for '{job_title}' in '{location}'...")
-        jobs = scrape_jobs(
-            site_name=CONFIG['JOB_SEARCH_SITES'],
-            search_term=job_title,
-            location=location,
-            results_wanted=CONFIG['MAX_JOBS_TO_SCRAPE'],
-            hours_old=72,
-            country_indeed=CONFIG['JOB_SEARCH_COUNTRY']
+            contact, answered = self._lookup_contact(company, title, url)
+            if contact:
+                self.contact_store.add_contact(company, contact)
+            elif answered:
+                # Only cache real "no email" answers, not API failures
+                self.contact_store.add_miss(company)
+            return contact, answered
+
+    def _find_contacts_batch(self, jobs):
+        """Look up contacts for several jobs in one prompt, falling back to per-job queries.
+        
+        Returns (contact or None, whether it was answered) per job, like _find_contact."""
+        pending = {}
+        for job in jobs:
+            company = job.get('company', 'Unknown Company')
+            if self.contact_store.get_contact(company) or self.contact_store.is_known_miss(company):
+                continue
+            key = self.contact_store.normalize(company)
+            if key and key not in pending:
+                pending[key] = job
+        
+        if len(pending) > 1:
+            self._seed_contacts_batch(list(pending.values()))
+        # Jobs resolved by the batch are now served from the contact store;
+        # anything the batch missed goes through a regular per-job query.
+        return [self._find_contact(job) for job in jobs]
+
+    def _seed_contacts_batch(self, jobs):
+        clip = lambda value: PromptTemplate.clip(value, CONFIG['PROMPT_FIELD_MAX_CHARS'])
+        listing = "\n".join(
+            f"{i}. Company: {clip(job.get('company', 'Unknown Company'))} | "
+            f"Title: {clip(job.get('title', 'Unknown Title'))} | URL: {clip(job.get('job_url', ''))}"
+            for i, job in enumerate(jobs)
         )
+        prompt = BATCH_CONTACT_LOOKUP_PROMPT.render(listing=listing)
         
-        print(f"Found {len(jobs)} jobs. Finding HR contacts...")
-        recipients = []
+        entries, _ = self.pplx.query_json(prompt, "You are a specialized contact finding assistant.",
+                                          'contact_lookup', json_start='[')
+        if not isinstance(entries, list):
+            return
         
-        for _, job in jobs.iterrows():
+        for entry in entries:
+            if not isinstance(entry, dict) or not isinstance(entry.get('index'), int):
+                continue
+            if not 0 <= entry['index'] < len(jobs):
+                continue
+            job = jobs[entry.pop('index')]
             company = job.get('company', 'Unknown Company')
-            title = job.get('title', 'Unknown Title')
-            url = job.get('job_url', '')
-            
-            prompt = f"""
-            Search for the HR Manager or Engineering Manager email for {company} which is currently hiring for {title}.
-            The job listing is here: {url}.
-            Try to find a specific person's name and email if possible.
-            Return ONLY a JSON object with: 
-            {{
-                "company_name": "{company}",
-                "recipient_name": "Name or 'HR Manager'",
-                "designation": "Specific Role",
-                "email": "email@example.com",
-                "job_title": "{title}",
-                "job_url": "{url}"
-            }}
-            If you cannot find an email, return null.
-            """
-            
-            result_str = self.pplx.query(prompt, "You are a specialized contact finding assistant.")
-            if result_str:
-                try:
-                    # Extract JSON from potential markdown
-                    json_match = re.search(r'\{.*\}', result_str, re.DOTALL)
-                    if json_match:
-                        contact = json.loads(json_match.group(0))
-                        if contact and contact.get('email'):
-                            recipients.append(contact)
-                            print(f"Found: {contact['email']} for {company}")
-                except:
-                    continue
+            if entry.get('email'):
+                contact = dict(entry, job_title=job.get('title', 'Unknown Title'),
+                               job_url=job.get('job_url', ''))
+                self.contact_store.add_contact(company, contact)
+                print(f"Found: {contact['email']} for {company}")
+            elif 'email' in entry:
+                self.contact_store.add_miss(company)
+
+    def _lookup_contact(self, company, title, url):
+        """Query the LLM for a contact. Returns (contact or None, whether the API answered)."""
+        prompt = CONTACT_LOOKUP_PROMPT.render(company=company, title=title, url=url)
         
-        if recipients:
-            df = pd.DataFrame(recipients)
-            df.to_csv(CONFIG['RECIPIENTS_CSV'], index=False)
-            print(f"Saved {len(recipients)} contacts to {CONFIG['RECIPIENTS_CSV']}")
-        else:
-            print("No contacts found.")
+        contact, answered = self.pplx.query_json(prompt, "You are a specialized contact finding assistant.",
+                                                 'contact_lookup')
+        if not answered:
+            return None, False
+        if isinstance(contact, dict) and contact.get('email'):
+            print(f"Found: {contact['email']} for {company}")
+            contact.setdefault('company_name', company)
+            return dict(contact, job_title=title, job_url=url), True
+        return None, True
 
     def analyze_resume(self, resume_path):
         self.resume_path = resume_path
@@ -290,39 +1936,48 @@ class JobApplicationSystem:
             self.resume_summary = "A qualified professional looking for opportunities."
 
     def generate_email_content(self, recipient):
-        prompt = f"""
-        Generate a highly personalized job application email.
-        Context:
-        - Recipient Name: {recipient['recipient_name']}
-        - Designation: {recipient['designation']}
-        - Company: {recipient['company_name']}
-        - Job Title: {recipient['job_title']}
-        - Job Details: {recipient.get('job_url', 'No URL provided')}
-        - My Resume Summary: {self.resume_summary}
-        
-        Requirements:
-        - Subject line must be professional and catchy.
-        - Body must mention specific requirements from the job if available.
-        - Tone: Enthusiastic but professional.
-        - Mention that a resume is attached.
-        
-        Output as JSON:
-        {{
-            "subject": "...",
-            "body": "..."
-        }}
-        """
-        
-        result_str = self.pplx.query(prompt, "You are an expert career consultant and copywriter.")
-        if result_str:
-            try:
-                json_match = re.search(r'\{.*\}', result_str, re.DOTALL)
-                if json_match:
-                    return json.loads(json_match.group(0))
-            except:
-                pass
+        prompt = EMAIL_GENERATION_PROMPT.render(
+            recipient_name=recipient['recipient_name'],
+            designation=recipient['designation'],
+            company_name=recipient['company_name'],
+            job_title=recipient['job_title'],
+            job_url=PromptTemplate.clip(recipient.get('job_url'), None) or 'No URL provided',
+            resume_summary=self.resume_summary
+        )
+        
+        content, _ = self.pplx.query_json(prompt, "You are an expert career consultant and copywriter.",
+                                          'email_generation')
+        if isinstance(content, dict):
+            return content
         return None
 
+    def generate_email_batch(self, recipients):
+        """Write emails for several recipients in one prompt. Returns a draft or None per recipient."""
+        clip = lambda value: PromptTemplate.clip(value, CONFIG['PROMPT_FIELD_MAX_CHARS'])
+        listing = "\n".join(
+            f"{i}. Company: {clip(recipient['company_name'])} | Job Title: {clip(recipient['job_title'])} | "
+            f"Recipient: {clip(recipient['recipient_name'])} ({clip(recipient['designation'])}) | "
+            f"Job Details: {clip(recipient.get('job_url')) or 'No URL provided'}"
+            for i, recipient in enumerate(recipients)
+        )
+        prompt = BATCH_EMAIL_GENERATION_PROMPT.render(recipients=listing, resume_summary=self.resume_summary)
+        
+        entries, _ = self.pplx.query_json(prompt, "You are an expert career consultant and copywriter.",
+                                          'email_generation', json_start='[')
+        drafts = [None] * len(recipients)
+        if not isinstance(entries, list):
+            return drafts
+        
+        for entry in entries:
+            if not isinstance(entry, dict) or not isinstance(entry.get('index'), int):
+                continue
+            if not 0 <= entry['index'] < len(recipients):
+                continue
+            if isinstance(entry.get('subject'), str) and isinstance(entry.get('body'), str) \
+                    and entry['subject'] and entry['body']:
+                drafts[entry['index']] = {'subject': entry['subject'], 'body': entry['body']}
+        return drafts
+
     def send_email(self, recipient_email, subject, body, attachment_path=None):
         message = MIMEMultipart()
         message['to'] = recipient_email
@@ -354,67 +2009,231 @@ class JobApplicationSystem:
                 return "QUOTA_ERROR"
             return False
 
+    def _get_drafts(self, recipients):
+        """Stored or freshly generated draft (or None) for each recipient, generated in batches.
+        
+        New drafts are stored straight away, so one that never gets sent is reused next run."""
+        drafts = []
+        for recipient in recipients:
+            draft = self.draft_store.get(recipient['email'], self.resume_summary)
+            drafts.append({'subject': draft['subject'], 'body': draft['body']} if draft else None)
+        
+        missing = [k for k, draft in enumerate(drafts) if not draft]
+        if len(missing) > 1:
+            for k, content in zip(missing, self.generate_email_batch([recipients[k] for k in missing])):
+                if content:
+                    self.draft_store.add(recipients[k], self.resume_summary, content)
+                    drafts[k] = content
+        # Recipients the batch missed get a regular single-recipient prompt
+        for k in missing:
+            if not drafts[k]:
+                drafts[k] = self.generate_email_content(recipients[k])
+                if drafts[k]:
+                    self.draft_store.add(recipients[k], self.resume_summary, drafts[k])
+        return drafts
+
+    def _pending_recipients(self, start_index, blocked_mgr, state_mgr):
+        """Yield (index, row) for each recipient still to email: earlier failed sends first, then file order.
+        
+        Follows a recipients file the prepare stage is still writing, yielding None each time
+        it catches up so the caller can decide when to poll again."""
+        next_index = start_index
+        retry_rows = sorted(i for i in state_mgr.state['retry_rows'] if i < start_index)
+        queued = set()
+        while True:
+            # Checked before reading so rows flushed by a finishing prepare run are not missed
+            preparing = RecipientsWriter.is_in_progress()
+            df = pd.read_csv(CONFIG['RECIPIENTS_CSV'])
+            
+            indices = [i for i in retry_rows if i < len(df)] + list(range(next_index, len(df)))
+            retry_rows = []
+            for i in indices:
+                next_index = max(next_index, i + 1)
+                row = df.iloc[i]
+                email = row['email']
+                
+                if blocked_mgr.is_blocked(email) or state_mgr.was_sent(email) or email in queued:
+                    print(f"Skipping {email} (blocked or duplicate)")
+                    continue
+                queued.add(email)
+                yield i, row
+            
+            if not preparing:
+                return
+            yield None
+
+    def generate_drafts(self, resume_path):
+        """Draft mode: write emails for every recipient still to be sent and store them for later sends."""
+        self.budget.start_clock()
+        self.analyze_resume(resume_path)
+        
+        if not os.path.exists(CONFIG['RECIPIENTS_CSV']):
+            print(f"Recipients file {CONFIG['RECIPIENTS_CSV']} not found.")
+            return
+        
+        state_mgr = SendingStateManager(self.sender_email)
+        recipients = self._pending_recipients(state_mgr.state['last_index_sent'] + 1,
+                                              BlockedDomainsManager(), state_mgr)
+        pending = []
+        for item in recipients:
+            if item is None:
+                print("Prepare stage still running; drafting the contacts found so far.")
+                break
+            _, row = item
+            if not self.draft_store.get(row['email'], self.resume_summary):
+                pending.append(row)
+        print(f"Generating {len(pending)} drafts ({len(self.draft_store)} already stored)...")
+        
+        drafted = failed = 0
+        workers = max(1, int(CONFIG['GENERATION_WORKERS']))
+        batch_size = max(1, int(CONFIG['EMAIL_BATCH_SIZE']))
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for batch, contents in zip(batches, executor.map(self._get_drafts, batches)):
+                for row, content in zip(batch, contents):
+                    if content:
+                        drafted += 1
+                    else:
+                        print(f"Failed to generate content for {row['email']}")
+                        failed += 1
+        except (BudgetExhausted, LLMUnavailable) as e:
+            print(f"Stopping drafts: {e}. Drafts so far are saved; run again to continue.")
+        finally:
+            executor.shutdown(cancel_futures=True)
+            self.draft_store.flush()
+        
+        print(f"Saved {drafted} new drafts to {CONFIG['DRAFTS_FILE']}" + (f" ({failed} failed)" if failed else ""))
+        self.print_llm_stats()
+
     def run_sending_process(self, resume_path, test_mode=False):
         if not self.gmail_service:
             print("Gmail service not authenticated.")
             return
 
+        self.budget.start_clock()
         self.analyze_resume(resume_path)
         
         if not os.path.exists(CONFIG['RECIPIENTS_CSV']):
             print(f"Recipients file {CONFIG['RECIPIENTS_CSV']} not found.")
             return
             
-        df = pd.read_csv(CONFIG['RECIPIENTS_CSV'])
         blocked_mgr = BlockedDomainsManager()
         state_mgr = SendingStateManager(self.sender_email)
         
         start_index = state_mgr.state['last_index_sent'] + 1
         print(f"Starting from index {start_index}...")
         
-        for i in range(start_index, len(df)):
-            row = df.iloc[i]
-            email = row['email']
-            
-            if blocked_mgr.is_blocked(email) or state_mgr.was_sent(email):
-                print(f"Skipping {email} (blocked or duplicate)")
-                continue
+        workers = max(1, int(CONFIG['GENERATION_WORKERS']))
+        window_size = max(1, int(CONFIG['DRAFT_QUEUE_SIZE']))
+        email_batch_size = max(1, int(CONFIG['EMAIL_BATCH_SIZE']))
+        recipients = self._pending_recipients(start_index, blocked_mgr, state_mgr)
+        # Drafts are generated up to window_size recipients ahead of the sender but consumed in
+        # file order, so the sender rarely waits on the LLM and last_index_sent only moves forward
+        drafts = deque()
+        input_done = False
+        next_poll = 0
+        previews = 0
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while True:
+                # Don't generate drafts that can never be previewed or sent
+                lookahead = window_size
+                if test_mode:
+                    lookahead = min(lookahead, self.TEST_MODE_PREVIEWS - previews)
+                elif self.budget.sends_left() is not None:
+                    lookahead = min(lookahead, self.budget.sends_left())
+                batch_size = max(1, min(email_batch_size, lookahead))
+                if not input_done and time.monotonic() >= next_poll:
+                    # Top up a whole batch at a time so batches don't shrink to one recipient per send
+                    while lookahead - len(drafts) >= batch_size \
+                            and not self.budget.exhausted(include_sends=not test_mode):
+                        batch = []
+                        while len(batch) < batch_size:
+                            item = next(recipients, False)
+                            if item is False:
+                                input_done = True
+                                break
+                            if item is None:
+                                next_poll = time.monotonic() + CONFIG['RECIPIENTS_POLL_SECONDS']
+                                break
+                            batch.append(item)
+                        if batch:
+                            future = executor.submit(self._get_drafts, [row for _, row in batch])
+                            drafts.extend((i, row, future, k) for k, (i, row) in enumerate(batch))
+                        if len(batch) < batch_size:
+                            break
                 
-            print(f"Processing {email} ({row['company_name']})...")
-            
-            content = self.generate_email_content(row)
-            if not content:
-                print(f"Failed to generate content for {email}")
-                continue
+                if not drafts:
+                    reason = self.budget.exhausted(include_sends=not test_mode)
+                    if reason:
+                        print(f"Stopping send: {reason}. Progress is saved; run again to continue.")
+                        break
+                    if input_done:
+                        break
+                    print("Prepare stage still running, waiting for more contacts...")
+                    time.sleep(max(0, next_poll - time.monotonic()))
+                    continue
                 
-            if test_mode:
-                print(f"--- TEST MODE ---")
-                print(f"To: {email}")
-                print(f"Subject: {content['subject']}")
-                print(f"Body: {content['body'][:100]}...")
-                print(f"-----------------")
-                if i >= start_index + 2: break # Limit test mode output
-                continue
+                i, row, future, k = drafts.popleft()
+                email = row['email']
+                print(f"Processing {email} ({row['company_name']})...")
                 
-            result = self.send_email(email, content['subject'], content['body'], resume_path)
-            
-            if result == True:
-                print(f"Sent successfully to {email}")
-                state_mgr.mark_sent(i, email)
-            elif result == "QUOTA_ERROR":
-                print("Stopping due to quota.")
-                break
-            else:
-                print(f"Failed to send to {email}")
-            
-            time.sleep(2) # Avoid rapid-fire triggers
+                try:
+                    content = future.result()[k]
+                except (BudgetExhausted, LLMUnavailable) as e:
+                    print(f"Stopping send: {e}. Progress is saved; run again to continue.")
+                    break
+                if not content:
+                    print(f"Failed to generate content for {email}")
+                    continue
+                    
+                if test_mode:
+                    print(f"--- TEST MODE ---")
+                    print(f"To: {email}")
+                    print(f"Subject: {content['subject']}")
+                    print(f"Body: {content['body'][:100]}...")
+                    print(f"-----------------")
+                    previews += 1
+                    if previews >= self.TEST_MODE_PREVIEWS: # Limit test mode output
+                        break
+                    continue
+                
+                # The draft's LLM cost is already paid, so only send and time limits apply here
+                reason = self.budget.exhausted(include_sends=True, include_llm=False)
+                if reason:
+                    print(f"Stopping send: {reason}. Progress is saved; run again to continue.")
+                    break
+                    
+                result = self.send_email(email, content['subject'], content['body'], resume_path)
+                
+                if result == True:
+                    print(f"Sent successfully to {email}")
+                    state_mgr.mark_sent(i, email)
+                    self.draft_store.remove(email, self.resume_summary)
+                    self.budget.charge_send()
+                elif result == "QUOTA_ERROR":
+                    print("Stopping due to quota.")
+                    break
+                else:
+                    # Its draft is kept and the row offered again next run
+                    print(f"Failed to send to {email}")
+                    state_mgr.mark_failed(i)
+                
+                time.sleep(CONFIG['SEND_DELAY_SECONDS']) # Avoid rapid-fire triggers
+        finally:
+            # Drafts still generating are waited for and kept along with every unsent one
+            executor.shutdown(cancel_futures=True)
+            self.draft_store.flush()
+        
+        self.print_llm_stats()
 
 
 def main():
     system = JobApplicationSystem()
     
     print("=== AI Job Application Mailer ===")
-    mode = input("Select Mode (prepare/send/both): ").strip().lower()
+    mode = input("Select Mode (prepare/draft/send/both): ").strip().lower()
     
     sender_email = input("Enter your Gmail address: ").strip()
     if not system.authenticate_gmail(sender_email):
@@ -426,9 +2245,18 @@ def main():
         blocked_mgr.add_domains(domains)
 
     if mode in ['prepare', 'both']:
-        job_title = input("What job title/tech stack are you looking for? (e.g. 'React.js developer'): ")
-        location = input(f"Location (default {CONFIG['JOB_SEARCH_LOCATION']}): ") or CONFIG['JOB_SEARCH_LOCATION']
-        system.scrape_and_find_contacts(job_title, location)
+        job_titles = input("What job titles/tech stacks are you looking for? Separate several with ';' "
+                           "(e.g. 'React.js developer; Node.js developer'): ")
+        locations = input(f"Locations, separated by ';' (default {CONFIG['JOB_SEARCH_LOCATION']}): ") \
+            or CONFIG['JOB_SEARCH_LOCATION']
+        system.scrape_and_find_contacts(
+            [t.strip() for t in job_titles.split(';') if t.strip()],
+            [l.strip() for l in locations.split(';') if l.strip()]
+        )
+        
+    if mode == 'draft':
+        resume_path = input("Path to your resume PDF: ").strip()
+        system.generate_drafts(resume_path)
         
     if mode in ['send', 'both']:
         resume_path = input("Path to your resume PDF: ").strip()
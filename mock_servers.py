@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the Perplexity and Gmail APIs.
+Serves an OpenAI-compatible chat completions endpoint that returns canned JSON for the
+mailer's prompts, and a fake Gmail send endpoint, so the whole pipeline can run offline.
+
+Usage:
+    python mock_servers.py --latency-ms 300 --error-rate 0.05
+    export PPLX_BASE_URL=http://127.0.0.1:8800
+    export GMAIL_API_ENDPOINT=http://127.0.0.1:8801
+    python main.py
+"""
+
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import argparse
+import threading
+from email import message_from_bytes
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULTS = {
+    'HOST': '127.0.0.1',
+    'LLM_PORT': 8800,
+    'GMAIL_PORT': 8801,
+    'LATENCY_MS': 200,
+    'LATENCY_JITTER_MS': 100,
+    'ERROR_RATE': 0.0,  # Fraction of LLM calls answered with a 429 or 5xx
+    'NO_EMAIL_RATE': 0.1,  # Fraction of contact lookups that find no email
+    'GMAIL_QUOTA': None,  # Sends accepted before Gmail starts answering 429
+}
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+', '', text.lower()) or 'company'
+
+
+class MockBehavior:
+    """Latency, error injection and counters shared by both mock servers."""
+
+    def __init__(self, latency_ms=DEFAULTS['LATENCY_MS'], latency_jitter_ms=DEFAULTS['LATENCY_JITTER_MS'],
+                 error_rate=DEFAULTS['ERROR_RATE'], no_email_rate=DEFAULTS['NO_EMAIL_RATE'],
+                 gmail_quota=DEFAULTS['GMAIL_QUOTA'], seed=None):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.no_email_rate = no_email_rate
+        self.gmail_quota = gmail_quota
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'llm_requests': 0, 'llm_errors': 0, 'gmail_sends': 0, 'gmail_rejections': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+            return self.counters[name]
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(0, self.latency_jitter_ms)
+        time.sleep((self.latency_ms + jitter) / 1000)
+
+
+def contact_reply(behavior, company, index=None):
+    if behavior.chance(behavior.no_email_rate):
+        contact = {'company_name': company, 'email': None}
+    else:
+        contact = {
+            'company_name': company,
+            'recipient_name': 'HR Manager',
+            'designation': 'Talent Acquisition',
+            'email': f'careers@{_slug(company)}.example.com',
+        }
+    if index is not None:
+        contact = dict(contact, index=index)
+    return contact
+
+
+def draft_reply(company, job_title, index=None):
+    draft = {
+        'subject': f'Application for {job_title} at {company}',
+        'body': f'Dear Hiring Team,\n\nI am excited to apply for the {job_title} role at {company}. '
+                f'My resume is attached.\n\nBest regards',
+    }
+    if index is not None:
+        draft = dict(draft, index=index)
+    return draft
+
+
+def canned_completion(behavior, prompt):
+    """Build a reply for one of the mailer's prompts, recognized by their fixed wording."""
+    if 'job application email' in prompt:
+        entries = re.findall(r'^(\d+)\. Company: (.*?) \| Job Title: (.*?)(?: \|.*)?$', prompt, re.MULTILINE)
+        if entries:
+            return json.dumps([draft_reply(company, title, int(i)) for i, company, title in entries])
+        company = re.search(r'Company: (.*)', prompt)
+        title = re.search(r'Job Title: (.*)', prompt)
+        return json.dumps(draft_reply(company.group(1) if company else 'your company',
+                                      title.group(1) if title else 'open'))
+
+    listings = re.findall(r'^(\d+)\. Company: (.*?) \|', prompt, re.MULTILINE)
+    if listings:
+        return 'Here are the contacts:\n```json\n' + json.dumps(
+            [contact_reply(behavior, company, int(i)) for i, company in listings]
+        ) + '\n```\n[1] company careers page'
+
+    company = re.search(r'Company: (.*)', prompt)
+    if company:
+        contact = contact_reply(behavior, company.group(1))
+        return 'null' if not contact['email'] else '```json\n' + json.dumps(contact) + '\n```'
+    return 'OK'
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI-compatible POST /chat/completions, with optional server-sent event streaming."""
+
+    behavior = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        self.behavior.count('llm_requests')
+        self.behavior.delay()
+
+        if self.behavior.chance(self.behavior.error_rate):
+            self.behavior.count('llm_errors')
+            if self.behavior.chance(0.5):
+                self._send_json(429, {'error': {'message': 'Rate limited'}}, {'Retry-After': '1'})
+            else:
+                self._send_json(503, {'error': {'message': 'Service unavailable'}})
+            return
+
+        messages = request.get('messages') or []
+        prompt = messages[-1].get('content', '') if messages else ''
+        content = canned_completion(self.behavior, prompt)
+        model = request.get('model', 'mock-model')
+        usage = {
+            'prompt_tokens': sum(len(m.get('content', '')) for m in messages) // 4,
+            'completion_tokens': len(content) // 4,
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:12]}'
+
+        if not request.get('stream'):
+            self._send_json(200, {
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': content}}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+        try:
+            for i, piece in enumerate(pieces):
+                chunk = {
+                    'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': {'content': piece},
+                                 'finish_reason': 'stop' if i == len(pieces) - 1 else None}],
+                }
+                if i == len(pieces) - 1:
+                    chunk['usage'] = usage
+                self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early once it had the JSON it needed
+            pass
+
+
+class MockGmailHandler(BaseHTTPRequestHandler):
+    """Fake POST .../users/{userId}/messages/send that accepts and records messages."""
+
+    behavior = None
+    sent = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.split('?')[0].endswith('/messages/send'):
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown path {self.path}'}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        quota = self.behavior.gmail_quota
+        if quota is not None and self.behavior.counters['gmail_sends'] >= quota:
+            self.behavior.count('gmail_rejections')
+            self._send_json(429, {'error': {'code': 429, 'message': 'User-rate limit exceeded',
+                                            'status': 'RESOURCE_EXHAUSTED'}})
+            return
+
+        message = message_from_bytes(base64.urlsafe_b64decode(request.get('raw', '')))
+        self.behavior.count('gmail_sends')
+        message_id = uuid.uuid4().hex[:16]
+        with self.behavior.lock:
+            self.sent.append({'id': message_id, 'to': message['to'], 'subject': message['subject']})
+        self._send_json(200, {'id': message_id, 'threadId': message_id, 'labelIds': ['SENT']})
+
+
+def _serve(handler_class, behavior, host, port):
+    handler = type(handler_class.__name__, (handler_class,), {'behavior': behavior, 'sent': []})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_mock_servers(behavior=None, host=DEFAULTS['HOST'], llm_port=DEFAULTS['LLM_PORT'],
+                       gmail_port=DEFAULTS['GMAIL_PORT']):
+    """Start both servers on background threads. Port 0 picks a free port.
+
+    Returns (llm_server, gmail_server); their base URL is http://host:server.server_port."""
+    behavior = behavior or MockBehavior()
+    llm_server = _serve(MockLLMHandler, behavior, host, llm_port)
+    gmail_server = _serve(MockGmailHandler, behavior, host, gmail_port)
+    return llm_server, gmail_server
+
+
+def server_url(server):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run local mock Perplexity and Gmail servers.')
+    parser.add_argument('--host', default=DEFAULTS['HOST'])
+    parser.add_argument('--llm-port', type=int, default=DEFAULTS['LLM_PORT'])
+    parser.add_argument('--gmail-port', type=int, default=DEFAULTS['GMAIL_PORT'])
+    parser.add_argument('--latency-ms', type=float, default=DEFAULTS['LATENCY_MS'])
+    parser.add_argument('--latency-jitter-ms', type=float, default=DEFAULTS['LATENCY_JITTER_MS'])
+    parser.add_argument('--error-rate', type=float, default=DEFAULTS['ERROR_RATE'])
+    parser.add_argument('--no-email-rate', type=float, default=DEFAULTS['NO_EMAIL_RATE'])
+    parser.add_argument('--gmail-quota', type=int, default=DEFAULTS['GMAIL_QUOTA'])
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    behavior = MockBehavior(args.latency_ms, args.latency_jitter_ms, args.error_rate,
+                            args.no_email_rate, args.gmail_quota, args.seed)
+    llm_server, gmail_server = start_mock_servers(behavior, args.host, args.llm_port, args.gmail_port)
+    print("=== Mock servers running (Ctrl-C to stop) ===")
+    print(f"export PPLX_BASE_URL={server_url(llm_server)}")
+    print(f"export GMAIL_API_ENDPOINT={server_url(gmail_server)}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"\nStopped. Counters: {behavior.counters}")
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Circuit breaker and retry classification for Perplexity calls.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, wait
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from main import CircuitBreaker, LLMUnavailable, PerplexityClient, RequestHedger, classify_llm_error
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeHTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.response = FakeResponse(status_code, headers)
+
+
+class ClassifyLLMErrorTest(unittest.TestCase):
+    def test_rate_limit_is_retryable_with_retry_after(self):
+        self.assertEqual(classify_llm_error(FakeHTTPError(429, {'retry-after': '3'})), (True, 3.0))
+
+    def test_server_errors_are_retryable(self):
+        self.assertEqual(classify_llm_error(FakeHTTPError(503)), (True, None))
+
+    def test_client_errors_are_not_retryable(self):
+        self.assertEqual(classify_llm_error(FakeHTTPError(400)), (False, None))
+        self.assertEqual(classify_llm_error(FakeHTTPError(401)), (False, None))
+
+    def test_network_errors_are_retryable(self):
+        self.assertEqual(classify_llm_error(requests.Timeout()), (True, None))
+        self.assertEqual(classify_llm_error(requests.ConnectionError()), (True, None))
+
+    def test_other_exceptions_are_not_retryable(self):
+        self.assertEqual(classify_llm_error(ValueError("bad SSE line")), (False, None))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold_and_lets_one_probe_through(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0)
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_probe_outcomes_close_or_reopen(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open())
+
+    def test_released_probe_lets_the_next_call_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.release_probe()
+        self.assertTrue(breaker.allow())
+
+
+class QueryAPIBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.client = PerplexityClient(api_key='test', use_cache=False, base_url='http://127.0.0.1:9')
+        self.client.rate_limiter = main.RateLimiter(requests_per_minute=10 ** 6, tokens_per_minute=10 ** 9)
+
+    def test_non_retryable_probe_failure_does_not_wedge_the_breaker(self):
+        self.client.breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+        self.client.breaker.record_failure()
+
+        def bad_request(*args):
+            raise FakeHTTPError(400)
+        self.client._send_request = bad_request
+
+        self.assertEqual(self.client._query_api('prompt', 'system', 'model'), (None, None))
+        self.assertFalse(self.client.breaker.probing)
+        self.assertTrue(self.client.breaker.allow())
+
+    def test_open_breaker_stops_the_caller(self):
+        self.client.breaker = CircuitBreaker(failure_threshold=1, reset_seconds=3600)
+        self.client.breaker.record_failure()
+        with self.assertRaises(LLMUnavailable):
+            self.client._query_api('prompt', 'system', 'model')
+
+
+class RequestHedgerTest(unittest.TestCase):
+    def test_success_wins_when_both_copies_finish_together(self):
+        calls = []
+        lock = threading.Lock()
+
+        def flaky():
+            with lock:
+                calls.append(None)
+                first = len(calls) == 1
+            time.sleep(0.1)
+            if first:
+                raise RuntimeError("primary failed")
+            return 'ok'
+
+        def wait_for_both(futures, timeout=None, return_when=ALL_COMPLETED):
+            if return_when == FIRST_COMPLETED:
+                return_when = ALL_COMPLETED
+            return wait(futures, timeout=timeout, return_when=return_when)
+
+        discarded = []
+        with mock.patch.object(main, 'wait', wait_for_both):
+            for _ in range(10):
+                hedger = RequestHedger(workers=2, percentile_rank=50, max_rate=1, min_samples=1)
+                hedger._observe('key', 0.01)
+                calls.clear()
+                self.assertEqual(hedger.run('key', flaky, on_discarded=discarded.append), 'ok')
+        self.assertEqual(len(discarded), 10)
+        self.assertTrue(all(isinstance(future.exception(), RuntimeError) for future in discarded))
+
+
+if __name__ == '__main__':
+    unittest.main()